@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-16 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0012_alter_bulkorderpayment_amount_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="inventoryitem",
+            index=models.Index(
+                fields=["product", "branch", "is_active", "expiry_date", "created_at"],
+                name="invitem_fifo_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-16 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("inventory", "0013_inventoryitem_invitem_fifo_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="inventoryitem",
+            index=models.Index(
+                fields=["branch", "is_active", "expiry_date"],
+                name="invitem_branch_expiry_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="inventoryitem",
+            index=models.Index(
+                fields=["branch", "is_active", "quantity"],
+                name="invitem_branch_qty_idx",
+            ),
+        ),
+    ]
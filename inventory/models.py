@@ -756,6 +756,18 @@ class InventoryItem(models.Model):
             models.Index(fields=["product", "batch_number"]),
             models.Index(fields=["expiry_date"]),
             models.Index(fields=["organization", "branch"]),
+            models.Index(
+                fields=["product", "branch", "is_active", "expiry_date", "created_at"],
+                name="invitem_fifo_idx",
+            ),
+            models.Index(
+                fields=["branch", "is_active", "expiry_date"],
+                name="invitem_branch_expiry_idx",
+            ),
+            models.Index(
+                fields=["branch", "is_active", "quantity"],
+                name="invitem_branch_qty_idx",
+            ),
         ]
 
     def __str__(self):
@@ -85,6 +85,23 @@ DATABASES = {
 }
 
 
+# Cache shared by every worker process, so clearing an entry (POS settings,
+# receipts) takes effect everywhere. The database cache table is created by
+# the pos migrations; point CACHE_BACKEND/CACHE_LOCATION at Redis or
+# Memcached to take cache reads off the database.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': config('CACHE_LOCATION', default='pharmacy_cache'),
+        'OPTIONS': {
+            # Room for a day of per-sale receipts before entries are culled
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=50000, cast=int),
+            'CULL_FREQUENCY': 4,
+        },
+    }
+}
+
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -179,6 +196,10 @@ EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=True, cast=bool)
 EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
 
+# POS: reject sales whose batch allocation does not match the sold quantity
+# instead of re-allocating those lines by FIFO
+POS_STRICT_BATCHES = config('POS_STRICT_BATCHES', default=False, cast=bool)
+
 
 # drf-spectular configuration
 SPECTACULAR_SETTINGS = {
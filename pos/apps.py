@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class PosConfig(AppConfig):
+    name = 'pos'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -37,18 +37,25 @@ def manager_dashboard_stats(request):
         else:  # year
             start_date = end_date - timedelta(days=365)
         
-        # Total Sales for this branch
-        sales = Sale.objects.filter(
+        # Total Sales, credit to receive (outstanding patient payments) and
+        # ongoing sales orders (current day sales) for this branch in one
+        # aggregate; the day always falls inside the selected range
+        today_start = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        sale_stats = Sale.objects.filter(
             branch_id=branch_id,
             created_at__gte=start_date,
             created_at__lte=end_date
+        ).aggregate(
+            total_sales=Sum('total_amount'),
+            credit_to_receive=Sum('credit_amount', filter=Q(credit_amount__gt=0)),
+            ongoing_sales_orders=Count('id', filter=Q(
+                created_at__gte=today_start,
+                status__in=['pending', 'processing']
+            ))
         )
-        total_sales = sales.aggregate(total=Sum('total_amount'))['total'] or Decimal('0')
-        
-        # Credit to receive (outstanding patient payments)
-        credit_to_receive = sales.filter(
-            credit_amount__gt=0
-        ).aggregate(total=Sum('credit_amount'))['total'] or Decimal('0')
+        total_sales = sale_stats['total_sales'] or Decimal('0')
+        credit_to_receive = sale_stats['credit_to_receive'] or Decimal('0')
+        ongoing_sales_orders = sale_stats['ongoing_sales_orders']
         
         # Credit to pay to vendors (outstanding supplier payments)
         credit_to_pay = PaymentRecord.objects.filter(
@@ -62,14 +69,6 @@ def manager_dashboard_stats(request):
             status__in=['submitted', 'supplier_reviewing', 'supplier_confirmed', 'buyer_confirmed', 'shipped']
         ).count()
         
-        # Ongoing sales orders (current day sales)
-        today_start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        ongoing_sales_orders = Sale.objects.filter(
-            branch_id=branch_id,
-            created_at__gte=today_start,
-            status__in=['pending', 'processing']
-        ).count()
-        
         return Response({
             'total_sales': float(total_sales),
             'credit_to_receive': float(credit_to_receive),
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-16 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pos", "0005_alter_customer_credit_limit_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["branch", "organization", "status", "-created_at"],
+                name="sale_branch_status_dt_idx",
+            ),
+        ),
+    ]
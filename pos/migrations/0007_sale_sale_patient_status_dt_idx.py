@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-16 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pos", "0006_sale_sale_branch_status_dt_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["patient", "status", "-created_at"],
+                name="sale_patient_status_dt_idx",
+            ),
+        ),
+    ]
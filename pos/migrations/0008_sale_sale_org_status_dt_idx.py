@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-16 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pos", "0007_sale_sale_patient_status_dt_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["organization", "status", "created_at"],
+                name="sale_org_status_dt_idx",
+            ),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from decimal import Decimal
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.validators import MinValueValidator
 from django.db import models
 from django.utils.translation import gettext_lazy as _
@@ -408,6 +409,18 @@ class Sale(models.Model):
         indexes = [
             models.Index(fields=["sale_date", "organization"]),
             models.Index(fields=["status", "sale_date"]),
+            models.Index(
+                fields=["branch", "organization", "status", "-created_at"],
+                name="sale_branch_status_dt_idx",
+            ),
+            models.Index(
+                fields=["patient", "status", "-created_at"],
+                name="sale_patient_status_dt_idx",
+            ),
+            models.Index(
+                fields=["organization", "status", "created_at"],
+                name="sale_org_status_dt_idx",
+            ),
         ]
 
     def __str__(self):
@@ -466,7 +479,7 @@ class SaleItem(models.Model):
     batch_number = models.CharField(max_length=50, blank=True)
     expiry_date = models.DateField(null=True, blank=True)
 
-    # Stock allocation details
+    # Stock allocation details (stored with the short keys from BATCH_KEYS)
     allocated_batches = models.JSONField(
         default=list, blank=True, help_text="Details of batch allocations"
     )
@@ -479,9 +492,41 @@ class SaleItem(models.Model):
         verbose_name = "Sale Item"
         verbose_name_plural = "Sale Items"
 
+    # Short keys used to store allocated_batches compactly
+    BATCH_KEYS = {
+        "inventory_item_id": "i",
+        "batch_number": "b",
+        "expiry_date": "e",
+        "allocated_quantity": "q",
+        "selling_price": "p",
+        "available_quantity": "a",
+    }
+    BATCH_KEYS_VERBOSE = {short: key for key, short in BATCH_KEYS.items()}
+
     def __str__(self):
         return f"{self.product.name} - {self.quantity}"
 
+    @classmethod
+    def compact_batches(cls, batches):
+        """Convert batch allocations to the short-key storage format."""
+        return [
+            {cls.BATCH_KEYS.get(key, key): value for key, value in batch.items()}
+            for batch in batches or []
+        ]
+
+    @classmethod
+    def expand_batches(cls, batches):
+        """Convert stored batch allocations back to verbose keys."""
+        return [
+            {cls.BATCH_KEYS_VERBOSE.get(key, key): value for key, value in batch.items()}
+            for batch in batches or []
+        ]
+
+    @property
+    def batches(self):
+        """Get batch allocations with verbose keys."""
+        return self.expand_batches(self.allocated_batches)
+
     @property
     def line_total(self):
         """Calculate line total after discount."""
@@ -746,5 +791,57 @@ class POSSettings(models.Model):
         verbose_name = "POS Settings"
         verbose_name_plural = "POS Settings"
 
+    # Seconds a branch's settings stay cached; saving them clears the entry
+    CACHE_TIMEOUT = 3600
+
     def __str__(self):
         return f"POS Settings - {self.branch.name}"
+
+    @staticmethod
+    def cache_key(organization_id, branch_id):
+        """Get the cache key for a branch's settings."""
+        return f"pos:settings:{organization_id}:{branch_id}"
+
+    @staticmethod
+    def receipts_version_key(organization_id):
+        """Get the cache key of the version stamped on an organization's cached receipts."""
+        return f"pos:receipts:{organization_id}:version"
+
+    @staticmethod
+    def default_branch_key(organization_id):
+        """Get the cache key of an organization's default branch id."""
+        return f"pos:default-branch:{organization_id}"
+
+    @classmethod
+    def get_default_branch_id(cls, organization_id):
+        """Get the id of the branch used for users without one, or None when there are no branches."""
+        return cache.get_or_set(
+            cls.default_branch_key(organization_id),
+            Branch.objects.filter(organization_id=organization_id).values_list("id", flat=True).first,
+            cls.CACHE_TIMEOUT,
+        )
+
+    @classmethod
+    def get_cached(cls, organization_id, branch_id):
+        """Get a branch's settings as a dict, or None when none are saved.
+
+        receipt_logo holds the logo URL instead of the file name.
+        """
+        key = cls.cache_key(organization_id, branch_id)
+        data = cache.get(key)
+        if data is None:
+            data = cls.objects.filter(organization_id=organization_id, branch_id=branch_id).values(
+                "business_name",
+                "business_address",
+                "business_phone",
+                "business_email",
+                "receipt_footer",
+                "receipt_logo",
+                "tax_rate",
+                "tax_inclusive",
+                "payment_methods",
+            ).first() or {}
+            if data.get("receipt_logo"):
+                data["receipt_logo"] = cls._meta.get_field("receipt_logo").storage.url(data["receipt_logo"])
+            cache.set(key, data, cls.CACHE_TIMEOUT)
+        return data or None
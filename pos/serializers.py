@@ -1,5 +1,7 @@
+import json
+
 from rest_framework import serializers
-from .models import Sale, SaleItem, Prescription, PrescriptionItem, Payment, Return, ReturnItem
+from .models import Sale, SaleItem, Prescription, PrescriptionItem, Payment, Return, ReturnItem, POSSettings
 from patients.models import Patient
 from inventory.models import Product, InventoryItem
 
@@ -33,6 +35,7 @@ class SaleItemSerializer(serializers.ModelSerializer):
     """Serializer for SaleItem model."""
     product = ProductSerializer(read_only=True)
     line_total = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+    allocated_batches = serializers.JSONField(source='batches', read_only=True)
     
     class Meta:
         model = SaleItem
@@ -173,4 +176,27 @@ class StockAllocationResponseSerializer(serializers.Serializer):
         child=serializers.DictField()
     )
     total_allocated = serializers.IntegerField()
-    medicine_id = serializers.IntegerField()
\ No newline at end of file
+    medicine_id = serializers.IntegerField()
+
+
+class POSSettingsSerializer(serializers.ModelSerializer):
+    """Serializer for saving a branch's POS settings."""
+    
+    class Meta:
+        model = POSSettings
+        fields = [
+            'business_name', 'business_address', 'business_phone',
+            'business_email', 'receipt_footer', 'receipt_logo', 'tax_rate',
+            'tax_inclusive', 'payment_methods'
+        ]
+        # The logo is only replaced by an uploaded file, see pos_settings
+        read_only_fields = ['receipt_logo']
+    
+    def validate_payment_methods(self, value):
+        """Accept payment methods sent as a JSON string by multipart forms."""
+        if isinstance(value, str):
+            try:
+                return json.loads(value)
+            except ValueError:
+                raise serializers.ValidationError('Invalid JSON list of payment methods.')
+        return value
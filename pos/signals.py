@@ -0,0 +1,32 @@
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from organizations.models import Branch, Organization
+
+from .models import POSSettings
+
+
+@receiver([post_save, post_delete], sender=POSSettings)
+def clear_pos_settings_cache(sender, instance, **kwargs):
+    """Drop the cached settings of a branch when they change."""
+    cache.delete(POSSettings.cache_key(instance.organization_id, instance.branch_id))
+    # Receipts embed the settings, so start a new receipt cache version
+    cache.set(POSSettings.receipts_version_key(instance.organization_id), time.time_ns(), None)
+
+
+@receiver([post_save, post_delete], sender=Branch)
+def clear_default_branch_cache(sender, instance, **kwargs):
+    """Drop the cached default branch of an organization when its branches change."""
+    cache.delete(POSSettings.default_branch_key(instance.organization_id))
+    # Receipts show the branch name
+    cache.set(POSSettings.receipts_version_key(instance.organization_id), time.time_ns(), None)
+
+
+@receiver(post_save, sender=Organization)
+def clear_organization_receipts_cache(sender, instance, **kwargs):
+    """Start a new receipt cache version when the organization details change."""
+    # Receipts fall back to the organization name, address, phone and email
+    cache.set(POSSettings.receipts_version_key(instance.id), time.time_ns(), None)
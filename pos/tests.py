@@ -0,0 +1,474 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.http import Http404
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from accounts.models import User
+from inventory.models import InventoryItem, Product
+from organizations.models import Branch, Organization
+
+from .models import POSSettings, Sale, SaleItem
+from .serializers import POSSettingsSerializer
+from .views import _find_stock_shortages, _reduce_allocated_stock, _reduce_stock_fifo, _sync_sale_items
+
+
+def _create_branch():
+    """Create an organization with one branch."""
+    organization = Organization.objects.create(
+        name='Test Pharmacy',
+        address='Main Road',
+        city='Kathmandu',
+        state='Bagmati',
+        postal_code='44600',
+        phone='9801234567',
+        email='pharmacy@example.com',
+        license_number='LIC-001',
+        license_expiry=date.today() + timedelta(days=365)
+    )
+    branch = Branch.objects.create(
+        name='Main Branch',
+        code='MAIN-001',
+        organization=organization,
+        address='Main Road',
+        city='Kathmandu',
+        state='Bagmati',
+        postal_code='44600',
+        phone='9801234567',
+        email='branch@example.com'
+    )
+    return organization, branch
+
+
+def _create_user(organization, branch):
+    """Create a cashier of the branch."""
+    return User.objects.create_user(
+        email='cashier@example.com',
+        password='password',
+        username='cashier',
+        first_name='Test',
+        last_name='Cashier',
+        phone='9801234567',
+        organization_id=organization.id,
+        branch_id=branch.id
+    )
+
+
+def _create_product(organization, product_code):
+    """Create a product of the organization."""
+    return Product.objects.create(
+        name='Paracetamol',
+        product_code=product_code,
+        cost_price=Decimal('1.00'),
+        selling_price=Decimal('2.00'),
+        organization=organization
+    )
+
+
+def _create_batch(product, branch, batch_number, quantity, expiry_date):
+    """Create an inventory batch of a product in the branch."""
+    return InventoryItem.objects.create(
+        product=product,
+        quantity=quantity,
+        cost_price=Decimal('1.00'),
+        batch_number=batch_number,
+        manufacturing_date=date.today() - timedelta(days=30),
+        expiry_date=expiry_date,
+        organization=branch.organization,
+        branch=branch
+    )
+
+
+class AllocatedBatchesTests(SimpleTestCase):
+    """Tests for the compact allocated_batches storage format."""
+
+    def test_compact_expand_round_trip(self):
+        batches = [{
+            'inventory_item_id': 7,
+            'batch_number': 'B-001',
+            'expiry_date': '2027-01-31',
+            'allocated_quantity': 3,
+            'selling_price': 12.5,
+            'available_quantity': 10
+        }]
+
+        compact = SaleItem.compact_batches(batches)
+
+        self.assertEqual(compact, [{'i': 7, 'b': 'B-001', 'e': '2027-01-31', 'q': 3, 'p': 12.5, 'a': 10}])
+        self.assertEqual(SaleItem.expand_batches(compact), batches)
+
+    def test_empty_batches(self):
+        self.assertEqual(SaleItem.compact_batches(None), [])
+        self.assertEqual(SaleItem.expand_batches(None), [])
+
+    def test_unknown_keys_are_kept(self):
+        self.assertEqual(SaleItem.expand_batches(SaleItem.compact_batches([{'note': 'x'}])), [{'note': 'x'}])
+
+class ReceiptCacheTests(APITestCase):
+    """Tests for clearing cached receipts when a sale or its organization changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.organization, self.branch = _create_branch()
+        self.user = _create_user(self.organization, self.branch)
+        self.sale = Sale.objects.create(
+            sale_number='BILL_TEST_0001',
+            organization=self.organization,
+            branch=self.branch,
+            subtotal=Decimal('100.00'),
+            total_amount=Decimal('100.00'),
+            amount_paid=Decimal('40.00'),
+            credit_amount=Decimal('60.00'),
+            status='completed',
+            created_by=self.user
+        )
+        self.receipt_url = reverse('pos:generate_receipt', args=[self.sale.sale_number])
+        self.client.force_authenticate(self.user)
+
+    def test_credit_payment_clears_cached_receipt(self):
+        response = self.client.get(self.receipt_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['totals']['credit'], 60.0)
+
+        # The receipt is cleared once the payment commits
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('pos:process_credit_payment', args=[self.sale.sale_number]),
+                {'amount': '25.00', 'payment_method': 'cash'},
+                format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.receipt_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['totals']['paid'], 65.0)
+        self.assertEqual(response.json()['totals']['credit'], 35.0)
+
+    def test_organization_save_clears_cached_receipt(self):
+        response = self.client.get(self.receipt_url)
+        self.assertEqual(response.json()['organization']['name'], 'Test Pharmacy')
+
+        self.organization.name = 'Renamed Pharmacy'
+        self.organization.save()
+
+        response = self.client.get(self.receipt_url)
+        self.assertEqual(response.json()['organization']['name'], 'Renamed Pharmacy')
+
+class SyncSaleItemsTests(TestCase):
+    """Tests for updating a pending bill's items in place."""
+
+    def setUp(self):
+        self.organization, self.branch = _create_branch()
+        self.kept = _create_product(self.organization, 'KEEP-1')
+        self.removed = _create_product(self.organization, 'DROP-1')
+        self.added = _create_product(self.organization, 'ADD-1')
+        self.sale = Sale.objects.create(
+            sale_number='PENDING_TEST_0001',
+            organization=self.organization,
+            branch=self.branch,
+            status='pending'
+        )
+        self.kept_item = SaleItem.objects.create(
+            sale=self.sale, product=self.kept, quantity=1, unit_price=Decimal('2.00')
+        )
+        SaleItem.objects.create(sale=self.sale, product=self.removed, quantity=2, unit_price=Decimal('2.00'))
+
+    def test_updates_inserts_and_deletes_items(self):
+        _sync_sale_items(self.sale, [
+            {'medicine_id': self.kept.id, 'quantity': 3, 'price': '2.50'},
+            {'medicine_id': self.added.id, 'quantity': 1, 'price': '4.00'}
+        ])
+
+        items = {item.product_id: item for item in SaleItem.objects.filter(sale=self.sale)}
+        self.assertEqual(set(items), {self.kept.id, self.added.id})
+        # The changed line is updated in place, not recreated
+        self.assertEqual(items[self.kept.id].id, self.kept_item.id)
+        self.assertEqual(items[self.kept.id].quantity, 3)
+        self.assertEqual(items[self.kept.id].unit_price, Decimal('2.50'))
+        self.assertEqual(items[self.added.id].quantity, 1)
+
+class StockReductionTests(TestCase):
+    """Tests for the guarded FIFO and allocated stock decrements."""
+
+    def setUp(self):
+        self.organization, self.branch = _create_branch()
+        self.product = _create_product(self.organization, 'PARA-500')
+        today = date.today()
+        self.first_batch = _create_batch(self.product, self.branch, 'B-001', 3, today + timedelta(days=30))
+        self.second_batch = _create_batch(self.product, self.branch, 'B-002', 2, today + timedelta(days=60))
+
+    def _assert_quantities(self, first, second):
+        self.first_batch.refresh_from_db()
+        self.second_batch.refresh_from_db()
+        self.assertEqual(self.first_batch.quantity, first)
+        self.assertEqual(self.second_batch.quantity, second)
+
+    def test_fifo_reduces_earliest_expiring_batches_first(self):
+        _reduce_stock_fifo(self.product, self.branch.id, 4, timezone.now())
+
+        self._assert_quantities(0, 1)
+
+    def test_fifo_shortage_raises_and_leaves_stock_unchanged(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                _reduce_stock_fifo(self.product, self.branch.id, 6, timezone.now())
+
+        self._assert_quantities(3, 2)
+
+    def test_allocated_stock_is_reduced_per_batch(self):
+        _reduce_allocated_stock({self.first_batch.id: 2, self.second_batch.id: 1}, timezone.now())
+
+        self._assert_quantities(1, 1)
+
+    def test_allocated_shortage_raises_and_leaves_stock_unchanged(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                _reduce_allocated_stock({self.first_batch.id: 1, self.second_batch.id: 5}, timezone.now())
+
+        self._assert_quantities(3, 2)
+
+    def test_allocated_unknown_batch_raises_404(self):
+        with self.assertRaises(Http404):
+            _reduce_allocated_stock({self.second_batch.id + 1000: 1}, timezone.now())
+
+class SaleStockCheckTests(APITestCase):
+    """Tests for checking the whole cart against branch stock before a sale."""
+
+    def setUp(self):
+        self.organization, self.branch = _create_branch()
+        self.user = _create_user(self.organization, self.branch)
+        self.product = _create_product(self.organization, 'PARA-500')
+        _create_batch(self.product, self.branch, 'B-001', 3, date.today() + timedelta(days=30))
+        self.client.force_authenticate(self.user)
+
+    def _create_sale(self, items):
+        return self.client.post(reverse('pos:create_sale'), {
+            'items': items,
+            'subtotal': '10.00',
+            'tax_amount': '0',
+            'discount_amount': '0',
+            'total': '10.00',
+            'paid_amount': '10.00'
+        }, format='json')
+
+    def test_find_stock_shortages_totals_demand_per_product(self):
+        shortages = _find_stock_shortages([
+            {'medicine_id': self.product.id, 'quantity': 2},
+            {'medicine_id': self.product.id, 'quantity': 2}
+        ], self.branch.id)
+
+        self.assertEqual(shortages, [{
+            'medicine_id': self.product.id,
+            'required_quantity': 4,
+            'available_stock': 3,
+            'shortage': 1
+        }])
+
+    def test_shortage_rejects_sale_before_any_write(self):
+        response = self._create_sale([{'medicine_id': self.product.id, 'quantity': 5, 'price': '2.00'}])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['shortages'][0]['shortage'], 2)
+        self.assertFalse(Sale.objects.exists())
+
+    def test_unknown_product_is_404(self):
+        response = self._create_sale([{'medicine_id': self.product.id + 1000, 'quantity': 1, 'price': '2.00'}])
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Sale.objects.exists())
+
+class DiscountTests(APITestCase):
+    """Tests for rejecting discounts larger than the subtotal."""
+
+    def setUp(self):
+        self.organization, self.branch = _create_branch()
+        self.user = _create_user(self.organization, self.branch)
+        self.client.force_authenticate(self.user)
+
+    def test_discount_above_subtotal_is_rejected(self):
+        response = self.client.post(reverse('pos:save_pending_bill'), {
+            'items': [],
+            'subtotal': '10.00',
+            'discount_amount': '15.00'
+        }, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Sale.objects.exists())
+
+class SaleErrorStatusTests(APITestCase):
+    """Tests for the status codes of failed sale writes."""
+
+    def setUp(self):
+        self.organization, self.branch = _create_branch()
+        self.user = _create_user(self.organization, self.branch)
+        self.sale = Sale.objects.create(
+            sale_number='BILL_TEST_0001',
+            organization=self.organization,
+            branch=self.branch,
+            total_amount=Decimal('100.00'),
+            credit_amount=Decimal('100.00'),
+            status='completed'
+        )
+        self.client.force_authenticate(self.user)
+
+    def test_malformed_amount_is_400(self):
+        response = self.client.post(
+            reverse('pos:process_credit_payment', args=[self.sale.sale_number]),
+            {'amount': 'ten', 'payment_method': 'cash'},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.sale.payments.exists())
+
+    def test_non_finite_amount_is_400(self):
+        response = self.client.post(reverse('pos:create_sale'), {'items': [], 'subtotal': 'NaN'}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_integrity_error_is_generic_409(self):
+        with patch('pos.views._persist_sale', side_effect=IntegrityError('constraint failed')):
+            response = self.client.post(reverse('pos:create_sale'), {'items': []}, format='json')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertNotIn('constraint failed', response.json()['error'])
+
+class PharmacyDashboardTests(APITestCase):
+    """Tests for the pharmacy dashboard aggregates."""
+
+    def setUp(self):
+        cache.clear()
+        self.organization, self.branch = _create_branch()
+        self.user = _create_user(self.organization, self.branch)
+        self.now = timezone.now()
+        self.client.force_authenticate(self.user)
+
+    def _create_sale(self, number, total, credit=Decimal('0'), status='completed', days_ago=0):
+        sale = Sale.objects.create(
+            sale_number=number,
+            organization=self.organization,
+            branch=self.branch,
+            total_amount=total,
+            credit_amount=credit,
+            status=status
+        )
+        # created_at is set on insert, so older sales are moved back afterwards
+        Sale.objects.filter(id=sale.id).update(created_at=self.now - timedelta(days=days_ago))
+        return sale
+
+    def test_dashboard_stats(self):
+        self._create_sale('BILL_1', Decimal('100.00'), credit=Decimal('40.00'))
+        self._create_sale('BILL_2', Decimal('200.00'), days_ago=10)
+        self._create_sale('PENDING_1', Decimal('500.00'), credit=Decimal('500.00'), status='pending')
+        product = _create_product(self.organization, 'PARA-500')
+        today = date.today()
+        _create_batch(product, self.branch, 'LOW', 5, today + timedelta(days=100))
+        _create_batch(product, self.branch, 'EXPIRING', 50, today + timedelta(days=10))
+
+        response = self.client.get(reverse('pos:pharmacy_dashboard_stats'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'totalSales': 100.0,
+            'patientCredit': 40.0,
+            'supplierCredit': 0.0,
+            'criticalStock': 1,
+            'expiringItems': 1
+        })
+
+    def test_weekly_sales_chart_groups_by_day(self):
+        self._create_sale('BILL_1', Decimal('100.00'), days_ago=2)
+        self._create_sale('BILL_2', Decimal('50.00'), days_ago=2)
+        # Today is outside the weekly chart
+        self._create_sale('BILL_3', Decimal('30.00'))
+
+        response = self.client.get(reverse('pos:pharmacy_sales_chart'), {'date_filter': 'week'})
+
+        self.assertEqual(response.status_code, 200)
+        chart = response.json()
+        self.assertEqual(len(chart), 7)
+        self.assertEqual(chart[5], {
+            'name': (self.now.date() - timedelta(days=2)).strftime('%a'),
+            'sales': 150.0,
+            'leads': 2
+        })
+        self.assertEqual(sum(day['sales'] for day in chart), 150.0)
+
+class RecentActivitiesTests(APITestCase):
+    """Tests for the pharmacy dashboard's recent activity feed."""
+
+    def setUp(self):
+        self.organization, self.branch = _create_branch()
+        self.user = _create_user(self.organization, self.branch)
+        self.client.force_authenticate(self.user)
+
+    def test_alerts_lead_then_most_recent_first(self):
+        now = timezone.now()
+        for number, hours_ago in [('BILL_OLD', 2), ('BILL_NEW', 1)]:
+            sale = Sale.objects.create(
+                sale_number=number,
+                organization=self.organization,
+                branch=self.branch,
+                total_amount=Decimal('10.00'),
+                status='completed'
+            )
+            Sale.objects.filter(id=sale.id).update(created_at=now - timedelta(hours=hours_ago))
+        product = _create_product(self.organization, 'PARA-500')
+        _create_batch(product, self.branch, 'LOW', 2, date.today() + timedelta(days=100))
+        _create_batch(product, self.branch, 'FULL', 50, date.today() + timedelta(days=100))
+
+        response = self.client.get(reverse('pos:pharmacy_recent_activities'))
+
+        self.assertEqual(response.status_code, 200)
+        activities = response.json()
+        self.assertEqual([activity['type'] for activity in activities], ['alert', 'stock', 'stock', 'sale', 'sale'])
+        self.assertEqual(activities[0]['description'], 'Paracetamol • 2 units remaining')
+        new_sale, old_sale = activities[3:]
+        self.assertGreater(new_sale['timestamp'], old_sale['timestamp'])
+
+class POSSettingsSerializerTests(TestCase):
+    """Tests for partial POS settings updates."""
+
+    def setUp(self):
+        self.organization, self.branch = _create_branch()
+        self.settings = POSSettings.objects.create(
+            organization=self.organization,
+            branch=self.branch,
+            business_name='Test Pharmacy',
+            tax_rate=Decimal('13.00')
+        )
+
+    def test_partial_update_parses_form_values(self):
+        serializer = POSSettingsSerializer(self.settings, data={
+            'tax_inclusive': 'true',
+            'payment_methods': '["cash", "card"]'
+        }, partial=True)
+
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save()
+        self.settings.refresh_from_db()
+        self.assertTrue(self.settings.tax_inclusive)
+        self.assertEqual(self.settings.payment_methods, ['cash', 'card'])
+        # Fields that were not sent are left alone
+        self.assertEqual(self.settings.business_name, 'Test Pharmacy')
+        self.assertEqual(self.settings.tax_rate, Decimal('13.00'))
+
+    def test_invalid_payment_methods_json(self):
+        serializer = POSSettingsSerializer(self.settings, data={'payment_methods': '[cash'}, partial=True)
+
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('payment_methods', serializer.errors)
+
+    def test_non_file_receipt_logo_is_ignored(self):
+        serializer = POSSettingsSerializer(self.settings, data={
+            'receipt_logo': 'http://testserver/media/pos/receipts/logo.png'
+        }, partial=True)
+
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertNotIn('receipt_logo', serializer.validated_data)
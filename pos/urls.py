@@ -17,6 +17,7 @@ urlpatterns = [
     path('sales/<int:sale_id>/update-pending/', views.update_pending_bill, name='update_pending_bill'),
     path('sales/complete/', views.complete_sale, name='complete_sale'),
     path('sales/pending/', views.get_pending_bills, name='get_pending_bills'),
+    path('sales/pending/<int:sale_id>/batches/', views.get_pending_bill_batches, name='get_pending_bill_batches'),
     path('sales/<str:sale_id>/', views.get_sale_detail, name='sale_detail'),
     path('sales/<str:sale_id>/delete/', views.delete_sale, name='delete_sale'),
     path('sales/<str:sale_id>/receipt/', views.generate_receipt, name='generate_receipt'),
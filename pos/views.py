@@ -1,21 +1,256 @@
+import logging
+
 from rest_framework import generics, status
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from django.db import transaction, models
+from django.conf import settings
+from django.db import IntegrityError, transaction, models
+from django.core.cache import cache
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from datetime import datetime, date
-import json
+from collections import Counter, defaultdict
+import time
+import uuid
+from decimal import Decimal, InvalidOperation
 
 from .models import Sale, SaleItem, Prescription, Payment, Return, POSSettings
+from .serializers import POSSettingsSerializer
 from patients.models import Patient
 from inventory.models import InventoryItem, Product
 from organizations.models import Branch, Organization
-from django.db.models import Sum, Count, Avg, Q, F
+from django.db.models import Sum, Count, Avg, Q, F, Prefetch, Case, When, Value, CharField
+from django.db.models.functions import ExtractHour, TruncDate
 from datetime import datetime, timedelta
 from .manager_dashboard_views import *
 
+logger = logging.getLogger(__name__)
+
+# Tax rate (percent) used when a branch has no POS settings
+DEFAULT_TAX_RATE = 13
+
+# Seconds a completed sale's receipt stays cached
+RECEIPT_CACHE_TIMEOUT = 86400
+
+# Seconds the dashboard's critical and expiring stock counts stay cached
+STOCK_COUNTS_CACHE_TIMEOUT = 300
+
+# Seconds a dashboard sales chart stays cached
+SALES_CHART_CACHE_TIMEOUT = 60
+
+
+def _to_decimal(value):
+    """Parse a request amount straight to Decimal for the money fields.
+
+    Malformed or non-finite amounts raise ValueError, which the sale views
+    answer with a 400.
+    """
+    try:
+        amount = Decimal(str(value or 0))
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value}")
+    if not amount.is_finite():
+        raise ValueError(f"Invalid amount: {value}")
+    return amount
+
+
+def _generate_sale_number(prefix, branch_id, now):
+    """Build a sale number that stays unique across terminals within the same second."""
+    timestamp = now.strftime('%Y%m%d%H%M%S')
+    return f"{prefix}_{branch_id}_{timestamp}_{uuid.uuid4().hex[:6].upper()}"
+
+
+def _receipt_cache_key(org_id, sale_ref):
+    """Get the cache key of a receipt looked up by sale id or sale number."""
+    version = cache.get_or_set(POSSettings.receipts_version_key(org_id), time.time_ns(), None)
+    return f"pos:receipt:{org_id}:{sale_ref}:{version}"
+
+
+def _clear_receipt_cache(sale):
+    """Drop the cached receipt of a sale under both of its lookup keys."""
+    cache.delete_many([
+        _receipt_cache_key(sale.organization_id, sale.id),
+        _receipt_cache_key(sale.organization_id, sale.sale_number),
+    ])
+
+
+def _load_pos_context(organization, branch_id):
+    """Resolve the receipt header, footer and tax rate once from the cached POS settings.
+
+    receipt_logo stays the storage URL, see _with_absolute_logo.
+    """
+    pos_settings = POSSettings.get_cached(organization.id, branch_id) or {}
+    return {
+        'business_name': pos_settings.get('business_name') or organization.name,
+        'business_address': pos_settings.get('business_address') or getattr(organization, 'address', ''),
+        'business_phone': pos_settings.get('business_phone') or getattr(organization, 'phone', ''),
+        'business_email': pos_settings.get('business_email') or getattr(organization, 'email', ''),
+        'receipt_footer': pos_settings.get('receipt_footer') or 'Thank you for your business!',
+        'receipt_logo': pos_settings.get('receipt_logo') or None,
+        'tax_rate': pos_settings.get('tax_rate', DEFAULT_TAX_RATE),
+    }
+
+
+def _with_absolute_logo(request, receipt_data):
+    """Make a receipt's logo URL absolute for the host of this request.
+
+    Receipts are cached with the storage URL, since the API is reached
+    through several hosts.
+    """
+    receipt_logo = receipt_data['settings']['receipt_logo']
+    if not receipt_logo:
+        return receipt_data
+    return {
+        **receipt_data,
+        'settings': {**receipt_data['settings'], 'receipt_logo': request.build_absolute_uri(receipt_logo)}
+    }
+
+
+def _get_tax_rate(org_id, branch_id):
+    """Get the branch tax rate as a fraction of the discounted subtotal.
+
+    Read from the database rather than the settings cache, since the rate
+    is written into the sale and must never be a stale cached value.
+    """
+    tax_rate = POSSettings.objects.filter(
+        organization_id=org_id,
+        branch_id=branch_id
+    ).values_list('tax_rate', flat=True).first()
+    if tax_rate is None:
+        tax_rate = DEFAULT_TAX_RATE
+    return Decimal(tax_rate) / 100
+
+
+def _discount_subtotal(subtotal, discount_amount):
+    """Apply the discount to the subtotal, rejecting discounts larger than it."""
+    if discount_amount > subtotal:
+        raise ValueError('Discount amount cannot exceed the subtotal')
+    return subtotal - discount_amount
+
+
+def _calculate_tax(discounted_subtotal, org_id, branch_id):
+    """Tax on the discounted subtotal, skipping the settings lookup when nothing is taxable."""
+    if discounted_subtotal <= 0:
+        return Decimal('0')
+    return (discounted_subtotal * _get_tax_rate(org_id, branch_id)).quantize(Decimal('0.01'))
+
+
+def _create_sale_items(sale, items, products=None):
+    """Bulk create a sale's cart items, returning (sale_item, batch_info) pairs."""
+    if products is None:
+        products = _get_products(items)
+    sale_allocations = [
+        (
+            SaleItem(
+                sale=sale,
+                product=products[int(item_data['medicine_id'])],
+                quantity=int(item_data['quantity']),
+                unit_price=_to_decimal(item_data['price']),
+                batch_number=item_data.get('batch', ''),
+                allocated_batches=SaleItem.compact_batches(item_data.get('batch_info'))
+            ),
+            item_data.get('batch_info') or []
+        )
+        for item_data in items
+    ]
+    SaleItem.objects.bulk_create([sale_item for sale_item, _ in sale_allocations], batch_size=500)
+    return sale_allocations
+
+
+def _sync_sale_items(sale, items):
+    """Make a sale's items match the cart, returning (sale_item, batch_info) pairs.
+
+    Lines are matched by product: changed lines are updated, new ones created
+    and the ones no longer in the cart deleted.
+    """
+    products = _get_products(items)
+    existing_items = {sale_item.product_id: sale_item for sale_item in sale.items.all()}
+    item_fields = ['quantity', 'unit_price', 'batch_number', 'allocated_batches']
+    new_items = []
+    changed_items = []
+    sale_allocations = []
+    for item_data in items:
+        product = products[int(item_data['medicine_id'])]
+        batch_info = item_data.get('batch_info') or []
+        values = {
+            'quantity': int(item_data['quantity']),
+            'unit_price': _to_decimal(item_data['price']),
+            'batch_number': item_data.get('batch', ''),
+            'allocated_batches': SaleItem.compact_batches(batch_info),
+        }
+        
+        sale_item = existing_items.pop(product.id, None)
+        if sale_item is None:
+            sale_item = SaleItem(sale=sale, product=product, **values)
+            new_items.append(sale_item)
+        else:
+            sale_item.product = product
+            if any(getattr(sale_item, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(sale_item, field, value)
+                changed_items.append(sale_item)
+        sale_allocations.append((sale_item, batch_info))
+    
+    if existing_items:
+        SaleItem.objects.filter(id__in=[sale_item.id for sale_item in existing_items.values()]).delete()
+    if changed_items:
+        SaleItem.objects.bulk_update(changed_items, item_fields, batch_size=500)
+    if new_items:
+        SaleItem.objects.bulk_create(new_items, batch_size=500)
+    return sale_allocations
+
+
+def _user_full_name(row, field):
+    """Get a user's full name from a values() row, like User.get_full_name()."""
+    if not row[field]:
+        return 'Unknown'
+    full_name = f"{row[f'{field}__first_name']} {row[f'{field}__last_name']}".strip()
+    return full_name or row[f'{field}__email']
+
+
+def _get_products(items):
+    """Fetch every product referenced by the cart items in a single query."""
+    product_ids = {int(item_data['medicine_id']) for item_data in items}
+    products = Product.objects.in_bulk(product_ids)
+    missing_ids = product_ids - products.keys()
+    if missing_ids:
+        raise Http404(f"Unknown products: {', '.join(str(product_id) for product_id in sorted(missing_ids))}")
+    return products
+
+
+def _get_available_stock(product_ids, branch_id):
+    """Map each product id to its active stock in the branch with one grouped query."""
+    return dict(InventoryItem.objects.filter(
+        product_id__in=product_ids,
+        branch_id=branch_id,
+        quantity__gt=0,
+        is_active=True
+    ).order_by().values_list('product_id').annotate(total=Sum('quantity')))
+
+
+def _find_stock_shortages(items, branch_id):
+    """List the cart products whose total demand exceeds the branch stock."""
+    demand = defaultdict(int)
+    for item_data in items:
+        demand[int(item_data['medicine_id'])] += int(item_data['quantity'])
+    stocks = _get_available_stock(demand, branch_id)
+    return [{
+        'medicine_id': product_id,
+        'required_quantity': required_quantity,
+        'available_stock': stocks.get(product_id, 0),
+        'shortage': required_quantity - stocks.get(product_id, 0)
+    } for product_id, required_quantity in demand.items() if stocks.get(product_id, 0) < required_quantity]
+
+
+def _stock_shortage_response(shortages):
+    """Reject a sale before any write when the cart cannot be covered."""
+    return Response({
+        'error': f'Insufficient stock for {len(shortages)} item(s)',
+        'shortages': shortages
+    }, status=400)
+
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -35,13 +270,14 @@ def allocate_stock(request):
             branch_id=branch_id,
             quantity__gt=0,
             is_active=True
-        ).order_by('expiry_date', 'created_at')
-        
-        if not inventory_items.exists():
-            return Response({'error': 'No stock available for this medicine'}, status=400)
+        ).order_by('expiry_date', 'created_at').only(
+            'id', 'batch_number', 'expiry_date', 'quantity', 'selling_price', 'cost_price'
+        )
         
         # Check total available stock
-        total_available = sum(item.quantity for item in inventory_items)
+        total_available = inventory_items.aggregate(total=Sum('quantity'))['total'] or 0
+        if not total_available:
+            return Response({'error': 'No stock available for this medicine'}, status=400)
         if total_available < quantity:
             return Response({'error': f'Insufficient stock. Available: {total_available}, Requested: {quantity}'}, status=400)
         
@@ -49,14 +285,15 @@ def allocate_stock(request):
         allocations = []
         remaining_quantity = quantity
         
-        print(f"DEBUG: allocate_stock - Need to allocate {quantity} units")
+        logger.debug("allocate_stock - Need to allocate %s units", quantity)
         
-        for item in inventory_items:
+        # Stop reading batches as soon as the quantity is covered
+        for item in inventory_items.iterator(chunk_size=50):
             if remaining_quantity <= 0:
                 break
                 
             allocated_quantity = min(item.quantity, remaining_quantity)
-            print(f"DEBUG: allocate_stock - Allocating {allocated_quantity} from batch {item.batch_number} (available: {item.quantity})")
+            logger.debug("allocate_stock - Allocating %s from batch %s (available: %s)", allocated_quantity, item.batch_number, item.quantity)
             
             allocations.append({
                 'inventory_item_id': item.id,
@@ -68,9 +305,9 @@ def allocate_stock(request):
             })
             
             remaining_quantity -= allocated_quantity
-            print(f"DEBUG: allocate_stock - Remaining to allocate: {remaining_quantity}")
+            logger.debug("allocate_stock - Remaining to allocate: %s", remaining_quantity)
         
-        print(f"DEBUG: allocate_stock - Final allocations: {allocations}")
+        logger.debug("allocate_stock - Final allocations: %s", allocations)
         return Response({
             'allocations': allocations,
             'total_allocated': quantity,
@@ -87,88 +324,7 @@ def save_pending_bill(request):
     """Save a pending bill without reducing stock."""
     try:
         with transaction.atomic():
-            data = request.data
-            
-            # Get or create patient
-            patient = None
-            patient_name = data.get('patient_name', '').strip()
-            patient_phone = data.get('patient_phone', '').strip()
-            patient_id = data.get('patient_id', '').strip()
-            
-            if patient_id:
-                try:
-                    patient = Patient.objects.get(patient_id=patient_id)
-                except Patient.DoesNotExist:
-                    pass
-            
-            if not patient and patient_name:
-                org_id = request.user.organization_id
-                timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                anonymous_patient_id = f"PT_{org_id}_{timestamp}"
-                
-                patient = Patient.objects.create(
-                    patient_id=anonymous_patient_id,
-                    first_name=patient_name.split()[0] if patient_name else 'Anonymous',
-                    last_name=' '.join(patient_name.split()[1:]) if len(patient_name.split()) > 1 else 'Patient',
-                    date_of_birth=date.today(),
-                    gender=data.get('patient_gender', 'other'),
-                    phone=patient_phone or '0000000000',
-                    address='Walk-in Customer',
-                    city='Unknown',
-                    organization_id=org_id,
-                    branch_id=data.get('branch_id'),
-                    patient_type='outpatient',
-                    created_by=request.user
-                )
-            
-            # Generate sale number
-            branch_id = data.get('branch_id') or request.user.branch_id
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            sale_number = f"PENDING_{branch_id}_{timestamp}"
-            
-            # Calculate amounts properly (discount before tax)
-            subtotal = float(data.get('subtotal', 0))
-            discount_amount = float(data.get('discount_amount', 0))
-            discounted_subtotal = subtotal - discount_amount
-            tax_amount = discounted_subtotal * 0.13
-            calculated_total = discounted_subtotal + tax_amount
-            
-            # Create pending sale
-            sale = Sale.objects.create(
-                sale_number=sale_number,
-                patient=patient,
-                patient_name=patient_name or (patient.get_full_name() if patient else 'Walk-in Customer'),
-                patient_age=data.get('patient_age', ''),
-                patient_phone=patient_phone,
-                patient_gender=data.get('patient_gender', ''),
-                sale_type=data.get('payment_method', 'cash'),
-                subtotal=subtotal,
-                tax_amount=tax_amount,
-                discount_amount=discount_amount,
-                total_amount=calculated_total,
-                amount_paid=0,  # No payment for pending bills
-                credit_amount=calculated_total,  # Full amount as credit
-                payment_method=data.get('payment_method', 'cash'),
-                organization_id=request.user.organization_id,
-                branch_id=branch_id,
-                created_by=request.user,
-                status='pending'  # Pending status
-            )
-            
-            # Process sale items (no stock reduction)
-            items = data.get('items', [])
-            for item_data in items:
-                product = get_object_or_404(Product, id=item_data['medicine_id'])
-                batch_info = item_data.get('batch_info', [])
-                
-                SaleItem.objects.create(
-                    sale=sale,
-                    product=product,
-                    quantity=item_data['quantity'],
-                    unit_price=item_data['price'],
-                    batch_number=item_data.get('batch', ''),
-                    allocated_batches=batch_info
-                )
+            sale, _ = _persist_sale(request, 'pending')
             
             return Response({
                 'success': True,
@@ -177,7 +333,16 @@ def save_pending_bill(request):
                 'message': 'Pending bill saved successfully'
             })
             
+    except Http404 as e:
+        return Response({'error': str(e)}, status=404)
+    except ValueError as e:
+        # Stock shortages, allocation mismatches and malformed quantities
+        return Response({'error': str(e)}, status=400)
+    except IntegrityError:
+        logger.exception("save_pending_bill failed")
+        return Response({'error': 'The sale could not be saved because it conflicts with existing data'}, status=409)
     except Exception as e:
+        logger.exception("save_pending_bill failed")
         return Response({'error': str(e)}, status=500)
 
 
@@ -202,10 +367,10 @@ def update_pending_bill(request, sale_id):
             sale.patient_gender = data.get('patient_gender', sale.patient_gender)
             
             # Update amounts
-            subtotal = float(data.get('subtotal', 0))
-            discount_amount = float(data.get('discount_amount', 0))
-            discounted_subtotal = subtotal - discount_amount
-            tax_amount = discounted_subtotal * 0.13
+            subtotal = _to_decimal(data.get('subtotal'))
+            discount_amount = _to_decimal(data.get('discount_amount'))
+            discounted_subtotal = _discount_subtotal(subtotal, discount_amount)
+            tax_amount = _calculate_tax(discounted_subtotal, sale.organization_id, sale.branch_id)
             calculated_total = discounted_subtotal + tax_amount
             
             sale.subtotal = subtotal
@@ -216,23 +381,8 @@ def update_pending_bill(request, sale_id):
             sale.payment_method = data.get('payment_method', sale.payment_method)
             sale.save()
             
-            # Delete existing items first
-            SaleItem.objects.filter(sale=sale).delete()
-            
-            # Add updated items
-            items = data.get('items', [])
-            for item_data in items:
-                product = get_object_or_404(Product, id=item_data['medicine_id'])
-                batch_info = item_data.get('batch_info', [])
-                
-                SaleItem.objects.create(
-                    sale=sale,
-                    product=product,
-                    quantity=item_data['quantity'],
-                    unit_price=item_data['price'],
-                    batch_number=item_data.get('batch', ''),
-                    allocated_batches=batch_info
-                )
+            # Write only the items that changed
+            _sync_sale_items(sale, data.get('items', []))
             
             return Response({
                 'success': True,
@@ -241,7 +391,16 @@ def update_pending_bill(request, sale_id):
                 'message': 'Pending bill updated successfully'
             })
             
+    except Http404 as e:
+        return Response({'error': str(e)}, status=404)
+    except ValueError as e:
+        # Stock shortages, allocation mismatches and malformed quantities
+        return Response({'error': str(e)}, status=400)
+    except IntegrityError:
+        logger.exception("update_pending_bill failed")
+        return Response({'error': 'The sale could not be saved because it conflicts with existing data'}, status=409)
     except Exception as e:
+        logger.exception("update_pending_bill failed")
         return Response({'error': str(e)}, status=500)
 
 
@@ -250,280 +409,272 @@ def update_pending_bill(request, sale_id):
 def complete_sale(request):
     """Complete a pending sale or create new sale with stock reduction."""
     try:
+        data = request.data
+        sale_id = data.get('sale_id')
+
+        if not sale_id:
+            # Create new direct sale
+            with transaction.atomic():
+                return create_direct_sale(request)
+
+        # Complete existing pending sale. Only the writes run inside the
+        # transaction; the receipt is built after commit so row locks are
+        # released as early as possible.
         with transaction.atomic():
-            data = request.data
-            sale_id = data.get('sale_id')
+            sale = get_object_or_404(Sale, id=sale_id, status='pending', organization_id=request.user.organization_id)
+            now = timezone.now()
             
-            if sale_id:
-                # Complete existing pending sale
-                sale = get_object_or_404(Sale, id=sale_id, status='pending', organization_id=request.user.organization_id)
-                
-                # Update sale with new data
-                paid_amount = float(data.get('paid_amount', 0))
-                total_amount = float(data.get('total', sale.total_amount))
-                
-                # Update all sale fields
-                sale.patient_name = data.get('patient_name', sale.patient_name)
-                sale.patient_age = data.get('patient_age', sale.patient_age)
-                sale.patient_phone = data.get('patient_phone', sale.patient_phone)
-                sale.patient_gender = data.get('patient_gender', sale.patient_gender)
-                sale.subtotal = float(data.get('subtotal', sale.subtotal))
-                sale.tax_amount = float(data.get('tax_amount', sale.tax_amount))
-                sale.discount_amount = float(data.get('discount_amount', sale.discount_amount))
-                sale.total_amount = total_amount
-                sale.amount_paid = paid_amount
-                sale.credit_amount = max(0, total_amount - paid_amount)
-                sale.change_amount = max(0, paid_amount - total_amount)
-                sale.payment_method = data.get('payment_method', sale.payment_method)
-                sale.transaction_id = data.get('transaction_id', '')
-                sale.status = 'completed'
-                sale.completed_by = request.user
-                
-                # Update sale number for completed sale
-                timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                sale.sale_number = f"BILL_{sale.branch_id}_{timestamp}"
-                
-                # Update items if provided
-                if 'items' in data:
-                    sale.items.all().delete()
-                    for item_data in data['items']:
-                        product = get_object_or_404(Product, id=item_data['medicine_id'])
-                        batch_info = item_data.get('batch_info', [])
-                        
-                        SaleItem.objects.create(
-                            sale=sale,
-                            product=product,
-                            quantity=item_data['quantity'],
-                            unit_price=item_data['price'],
-                            batch_number=item_data.get('batch', ''),
-                            allocated_batches=batch_info
-                        )
-                
-                sale.save()
-                
-                # Reduce stock for all items - stock was already allocated during cart operations
-                print(f"DEBUG: Starting stock reduction for sale {sale.id}")
-                print(f"DEBUG: Sale items count: {sale.items.count()}")
-
-                for sale_item in sale.items.all():
-                    print(f"DEBUG: Processing sale item: {sale_item.product.name}, quantity: {sale_item.quantity}")
-                    print(f"DEBUG: Allocated batches: {sale_item.allocated_batches}")
-                    
-                    # Check if allocated_batches is empty or None
-                    if not sale_item.allocated_batches:
-                        print(f"DEBUG: No allocated batches found for {sale_item.product.name}, using FIFO allocation")
-                        # If no allocated batches, do FIFO allocation now
-                        inventory_items = InventoryItem.objects.filter(
-                            product_id=sale_item.product.id,
-                            branch_id=sale.branch_id,
-                            quantity__gt=0,
-                            is_active=True
-                        ).order_by('expiry_date', 'created_at')
-                        
-                        remaining_quantity = sale_item.quantity
-                        for item in inventory_items:
-                            if remaining_quantity <= 0:
-                                break
-                            
-                            allocated_quantity = min(item.quantity, remaining_quantity)
-                            print(f"DEBUG: FIFO - Reducing {allocated_quantity} from batch {item.batch_number} (current: {item.quantity})")
-                            
-                            if item.quantity >= allocated_quantity:
-                                item.quantity -= allocated_quantity
-                                item.save()
-                                remaining_quantity -= allocated_quantity
-                                print(f"DEBUG: FIFO - Stock reduced successfully. New quantity: {item.quantity}")
-                            else:
-                                print(f"DEBUG: FIFO - ERROR - Insufficient stock in batch {item.batch_number}")
-                                raise ValueError(f"Insufficient stock in batch {item.batch_number}")
-                        
-                        if remaining_quantity > 0:
-                            print(f"DEBUG: FIFO - ERROR - Could not allocate all stock. Remaining: {remaining_quantity}")
-                            raise ValueError(f"Insufficient total stock for {sale_item.product.name}")
-                    else:
-                        # Use existing allocated batches
-                        total_allocated = sum(batch['allocated_quantity'] for batch in sale_item.allocated_batches)
-                        print(f"DEBUG: Sale item {sale_item.product.name} - allocated: {total_allocated}, required: {sale_item.quantity}")
-
-                        # Verify total allocated matches sale quantity
-                        if total_allocated != sale_item.quantity:
-                            print(f"DEBUG: ERROR - Stock allocation mismatch for {sale_item.product.name}: allocated {total_allocated}, required {sale_item.quantity}")
-                            raise ValueError(f"Stock allocation mismatch for {sale_item.product.name}: allocated {total_allocated}, required {sale_item.quantity}")
-
-                        # Actually reduce stock now
-                        for batch in sale_item.allocated_batches:
-                            print(f"DEBUG: Processing batch: {batch}")
-                            inventory_item = get_object_or_404(InventoryItem, id=batch['inventory_item_id'])
-                            allocated_qty = batch['allocated_quantity']
-
-                            print(f"DEBUG: Reducing stock for {sale_item.product.name} batch {batch['batch_number']}: current={inventory_item.quantity}, reducing={allocated_qty}")
-
-                            if inventory_item.quantity >= allocated_qty:
-                                inventory_item.quantity -= allocated_qty
-                                inventory_item.save()
-                                print(f"DEBUG: Stock reduced successfully. New quantity: {inventory_item.quantity}")
-                            else:
-                                print(f"DEBUG: ERROR - Insufficient stock in batch {batch['batch_number']}: has {inventory_item.quantity}, need {allocated_qty}")
-                                raise ValueError(f"Insufficient stock in batch {batch['batch_number']}")
-                
-                # Handle split payments or single payment
-                split_payments = data.get('split_payments')
-                if split_payments and len(split_payments) > 0:
-                    # Create multiple payment records for split payments
-                    for split_payment in split_payments:
-                        if split_payment.get('amount') and float(split_payment['amount']) > 0:
-                            Payment.objects.create(
-                                sale=sale,
-                                amount=float(split_payment['amount']),
-                                payment_method=split_payment.get('method', 'cash'),
-                                reference_number=split_payment.get('transaction_id', ''),
-                                received_by=request.user
-                            )
-                elif paid_amount > 0:
-                    # Single payment record
-                    Payment.objects.create(
-                        sale=sale,
-                        amount=paid_amount,
-                        payment_method=data.get('payment_method', 'cash'),
-                        reference_number=data.get('transaction_id', ''),
-                        received_by=request.user
-                    )
-                
-                # Generate receipt data with POS settings
-                organization = sale.organization
-                branch = sale.branch
-                
-                # Get POS settings for receipt
-                try:
-                    pos_settings = POSSettings.objects.get(organization_id=sale.organization_id, branch_id=sale.branch_id)
-                    business_name = pos_settings.business_name or organization.name
-                    business_address = pos_settings.business_address or getattr(organization, 'address', '')
-                    business_phone = pos_settings.business_phone or getattr(organization, 'phone', '')
-                    business_email = pos_settings.business_email or getattr(organization, 'email', '')
-                    receipt_footer = pos_settings.receipt_footer or 'Thank you for your business!'
-                    receipt_logo = request.build_absolute_uri(pos_settings.receipt_logo.url) if pos_settings.receipt_logo else None
-                    tax_rate = pos_settings.tax_rate
-                except POSSettings.DoesNotExist:
-                    business_name = organization.name
-                    business_address = getattr(organization, 'address', '')
-                    business_phone = getattr(organization, 'phone', '')
-                    business_email = getattr(organization, 'email', '')
-                    receipt_footer = 'Thank you for your business!'
-                    receipt_logo = None
-                    tax_rate = 13
-                
-                receipt_data = {
-                    'organization': {
-                        'name': business_name,
-                        'address': business_address,
-                        'phone': business_phone,
-                        'email': business_email
-                    },
-                    'branch': {
-                        'name': branch.name if branch else ''
-                    },
-                    'settings': {
-                        'receipt_footer': receipt_footer,
-                        'receipt_logo': receipt_logo,
-                        'tax_rate': tax_rate
-                    },
-                    'sale': {
-                        'sale_number': sale.sale_number,
-                        'sale_date': sale.created_at.strftime('%Y-%m-%d %I:%M %p'),
-                        'cashier': request.user.get_full_name() or request.user.username
-                    },
-                    'patient': {
-                        'name': sale.patient_name,
-                        'patient_id': sale.patient.patient_id if sale.patient else '',
-                        'age': sale.patient_age,
-                        'phone': sale.patient_phone,
-                        'gender': sale.patient_gender
-                    },
-                    'items': [{
-                        'name': item.product.name,
-                        'quantity': item.quantity,
-                        'unit_price': float(item.unit_price),
-                        'total': float(item.quantity * item.unit_price),
-                        'batch': item.batch_number
-                    } for item in sale.items.all()],
-                    'totals': {
-                        'subtotal': float(sale.subtotal),
-                        'tax': float(sale.tax_amount),
-                        'discount': float(sale.discount_amount),
-                        'total': float(sale.total_amount),
-                        'paid': float(sale.amount_paid),
-                        'credit': float(sale.credit_amount),
-                        'change': float(sale.change_amount)
-                    },
-                    'payment_method': sale.payment_method
-                }
-                
-                return Response({
-                    'success': True,
-                    'sale_id': sale.id,
-                    'sale_number': sale.sale_number,
-                    'message': 'Sale completed successfully',
-                    'receipt': receipt_data
-                })
+            # Update sale with new data
+            paid_amount = _to_decimal(data.get('paid_amount'))
+            total_amount = _to_decimal(data.get('total', sale.total_amount))
+            
+            # Update all sale fields
+            sale.patient_name = data.get('patient_name', sale.patient_name)
+            sale.patient_age = data.get('patient_age', sale.patient_age)
+            sale.patient_phone = data.get('patient_phone', sale.patient_phone)
+            sale.patient_gender = data.get('patient_gender', sale.patient_gender)
+            sale.subtotal = _to_decimal(data.get('subtotal', sale.subtotal))
+            sale.tax_amount = _to_decimal(data.get('tax_amount', sale.tax_amount))
+            sale.discount_amount = _to_decimal(data.get('discount_amount', sale.discount_amount))
+            sale.total_amount = total_amount
+            sale.amount_paid = paid_amount
+            sale.credit_amount = max(0, total_amount - paid_amount)
+            sale.change_amount = max(0, paid_amount - total_amount)
+            sale.payment_method = data.get('payment_method', sale.payment_method)
+            sale.transaction_id = data.get('transaction_id', '')
+            sale.status = 'completed'
+            sale.completed_by = request.user
+            
+            # Update sale number for completed sale
+            sale.sale_number = _generate_sale_number('BILL', sale.branch_id, now)
             
+            # Update items if provided
+            if 'items' in data:
+                # Keep the request's batch info so the items are not re-read below
+                sale_allocations = _sync_sale_items(sale, data['items'])
             else:
-                # Create new direct sale
-                return create_direct_sale(request)
+                sale_allocations = [(sale_item, sale_item.batches) for sale_item in sale.items.select_related('product')]
+            
+            sale.save()
+            
+            # Reduce stock for all items - stock was already allocated during cart operations
+            logger.debug("Starting stock reduction for sale %s", sale.id)
+            logger.debug("Sale items count: %s", len(sale_allocations))
+
+            allocated_stock = Counter()
+            for sale_item, allocated_batches in sale_allocations:
+                logger.debug("Processing sale item: %s, quantity: %s", sale_item.product.name, sale_item.quantity)
+                logger.debug("Allocated batches: %s", allocated_batches)
+                
+                # Check if allocated_batches is empty or None
+                if not allocated_batches:
+                    logger.debug("No allocated batches found for %s, using FIFO allocation", sale_item.product.name)
+                    # If no allocated batches, do FIFO allocation now
+                    _reduce_stock_fifo(sale_item.product, sale.branch_id, sale_item.quantity, now)
+                else:
+                    # Use existing allocated batches
+                    total_allocated, batch_quantities = _group_batch_quantities(allocated_batches)
+                    logger.debug("Sale item %s - allocated: %s, required: %s", sale_item.product.name, total_allocated, sale_item.quantity)
+
+                    # Verify total allocated matches sale quantity
+                    if total_allocated != sale_item.quantity:
+                        logger.debug("Stock allocation mismatch for %s: allocated %s, required %s", sale_item.product.name, total_allocated, sale_item.quantity)
+                        raise ValueError(f"Stock allocation mismatch for {sale_item.product.name}: allocated {total_allocated}, required {sale_item.quantity}")
+
+                    allocated_stock.update(batch_quantities)
+            
+            # Actually reduce stock now, for all allocated batches at once
+            _reduce_allocated_stock(allocated_stock, now)
+            
+            # Handle split payments or single payment
+            Payment.objects.bulk_create(_build_payments(sale, data, paid_amount, request.user))
+            
+            sale_id = sale.id
+        
+        # Reload the committed sale with its relations for the receipt
+        sale = Sale.objects.select_related('organization', 'branch', 'patient').defer('notes', 'internal_notes').get(id=sale_id)
+        receipt_data = _build_completed_receipt(request, sale, [sale_item for sale_item, _ in sale_allocations])
+        
+        return Response({
+            'success': True,
+            'sale_id': sale.id,
+            'sale_number': sale.sale_number,
+            'message': 'Sale completed successfully',
+            'receipt': receipt_data
+        })
                 
+    except Http404 as e:
+        return Response({'error': str(e)}, status=404)
+    except ValueError as e:
+        # Stock shortages, allocation mismatches and malformed quantities
+        return Response({'error': str(e)}, status=400)
+    except IntegrityError:
+        logger.exception("complete_sale failed")
+        return Response({'error': 'The sale could not be saved because it conflicts with existing data'}, status=409)
     except Exception as e:
+        logger.exception("complete_sale failed")
         return Response({'error': str(e)}, status=500)
 
 
-def create_direct_sale(request):
-    """Create a direct sale with immediate stock reduction."""
-    data = request.data
+def _build_payments(sale, data, paid_amount, user):
+    """Build the unsaved payment records for a sale's split or single payment."""
+    split_payments = data.get('split_payments')
+    if split_payments:
+        return [
+            Payment(
+                sale=sale,
+                amount=_to_decimal(split_payment['amount']),
+                payment_method=split_payment.get('method', 'cash'),
+                reference_number=split_payment.get('transaction_id', ''),
+                received_by=user
+            )
+            for split_payment in split_payments
+            if split_payment.get('amount') and _to_decimal(split_payment['amount']) > 0
+        ]
+    if paid_amount > 0:
+        return [Payment(
+            sale=sale,
+            amount=paid_amount,
+            payment_method=data.get('payment_method', 'cash'),
+            reference_number=data.get('transaction_id', ''),
+            received_by=user
+        )]
+    return []
+
+
+def _build_completed_receipt(request, sale, sale_items):
+    """Build receipt data with POS settings for a just-completed sale.
+
+    ``sale_items`` are the sale's items as written by the request, with their
+    products loaded, so the receipt needs no query for its lines.
+    """
+    organization = sale.organization
+    branch = sale.branch
+    
+    # Get POS settings for receipt
+    pos_context = _load_pos_context(organization, sale.branch_id)
     
-    # Get or create patient
-    patient = None
+    return _with_absolute_logo(request, {
+        'organization': {
+            'name': pos_context['business_name'],
+            'address': pos_context['business_address'],
+            'phone': pos_context['business_phone'],
+            'email': pos_context['business_email']
+        },
+        'branch': {
+            'name': branch.name if branch else '',
+            'address': getattr(branch, 'address', ''),
+            'phone': getattr(branch, 'phone', '')
+        },
+        'settings': {
+            'receipt_footer': pos_context['receipt_footer'],
+            'receipt_logo': pos_context['receipt_logo'],
+            'tax_rate': pos_context['tax_rate']
+        },
+        'sale': {
+            'sale_number': sale.sale_number,
+            'sale_date': sale.created_at.isoformat(timespec='seconds'),
+            'cashier': request.user.get_full_name() or request.user.username
+        },
+        'patient': {
+            'name': sale.patient_name,
+            'patient_id': sale.patient.patient_id if sale.patient else '',
+            'age': sale.patient_age,
+            'phone': sale.patient_phone,
+            'gender': sale.patient_gender
+        },
+        'items': [{
+            'name': item.product.name,
+            'quantity': item.quantity,
+            'unit_price': float(item.unit_price),
+            'total': float(item.quantity * item.unit_price),
+            'batch': item.batch_number
+        } for item in sale_items],
+        'totals': {
+            'subtotal': float(sale.subtotal),
+            'tax': float(sale.tax_amount),
+            'discount': float(sale.discount_amount),
+            'total': float(sale.total_amount),
+            'paid': float(sale.amount_paid),
+            'credit': float(sale.credit_amount),
+            'change': float(sale.change_amount)
+        },
+        'payment_method': sale.payment_method
+    })
+
+
+def _get_or_create_patient(request, org_id, branch_id, now):
+    """Find the sale's patient by patient_id or register a walk-in patient by name."""
+    data = request.data
     patient_name = data.get('patient_name', '').strip()
     patient_phone = data.get('patient_phone', '').strip()
     patient_id = data.get('patient_id', '').strip()
     
     if patient_id:
-        try:
-            patient = Patient.objects.get(patient_id=patient_id)
-        except Patient.DoesNotExist:
-            pass
+        # The sale only reads the patient's id and name
+        patient = Patient.objects.only('id', 'patient_id', 'first_name', 'last_name').filter(
+            patient_id=patient_id
+        ).first()
+        if patient:
+            return patient
     
-    if not patient and patient_name:
-        org_id = request.user.organization_id
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        anonymous_patient_id = f"PT_{org_id}_{timestamp}"
-        
-        patient = Patient.objects.create(
-            patient_id=anonymous_patient_id,
-            first_name=patient_name.split()[0] if patient_name else 'Anonymous',
-            last_name=' '.join(patient_name.split()[1:]) if len(patient_name.split()) > 1 else 'Patient',
-            date_of_birth=date.today(),
-            gender=data.get('patient_gender', 'other'),
-            phone=patient_phone or '0000000000',
-            address='Walk-in Customer',
-            city='Unknown',
-            organization_id=org_id,
-            branch_id=data.get('branch_id'),
-            patient_type='outpatient',
-            created_by=request.user
-        )
+    if not patient_name:
+        return None
     
-    # Generate sale number
+    timestamp = now.strftime('%Y%m%d%H%M%S')
+    anonymous_patient_id = f"PT_{org_id}_{timestamp}"
+    name_parts = patient_name.split()
+    
+    return Patient.objects.create(
+        patient_id=anonymous_patient_id,
+        first_name=name_parts[0],
+        last_name=' '.join(name_parts[1:]) or 'Patient',
+        date_of_birth=now.date(),
+        gender=data.get('patient_gender', 'other'),
+        phone=patient_phone or '0000000000',
+        address='Walk-in Customer',
+        city='Unknown',
+        organization_id=org_id,
+        branch_id=branch_id,
+        patient_type='outpatient',
+        created_by=request.user
+    )
+
+
+def _persist_sale(request, status, amounts=None, products=None):
+    """Create a sale with its patient, items, stock reduction and payments.
+
+    Completed sales reduce stock and record payments, pending bills only
+    store the cart. ``amounts`` is an optional (subtotal, tax_amount,
+    discount_amount, total_amount) tuple that replaces the server-side totals.
+    ``products`` are the cart products when the caller already fetched them.
+    Returns the sale and its created items.
+    """
+    data = request.data
+    org_id = request.user.organization_id
     branch_id = data.get('branch_id') or request.user.branch_id
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    sale_number = f"BILL_{branch_id}_{timestamp}"
+    is_completed = status == 'completed'
+    now = timezone.now()
+    
+    patient_name = data.get('patient_name', '').strip()
+    patient_phone = data.get('patient_phone', '').strip()
+    patient = _get_or_create_patient(request, org_id, branch_id, now)
+    
+    # Generate sale number
+    sale_number = _generate_sale_number('BILL' if is_completed else 'PENDING', branch_id, now)
     
     # Calculate amounts properly (discount before tax)
-    subtotal = float(data.get('subtotal', 0))
-    discount_amount = float(data.get('discount_amount', 0))
-    discounted_subtotal = subtotal - discount_amount
-    tax_amount = discounted_subtotal * 0.13
-    calculated_total = discounted_subtotal + tax_amount
-    paid_amount = float(data.get('paid_amount', 0))
+    if amounts is None:
+        subtotal = _to_decimal(data.get('subtotal'))
+        discount_amount = _to_decimal(data.get('discount_amount'))
+        discounted_subtotal = _discount_subtotal(subtotal, discount_amount)
+        tax_amount = _calculate_tax(discounted_subtotal, org_id, branch_id)
+        total_amount = discounted_subtotal + tax_amount
+    else:
+        subtotal, tax_amount, discount_amount, total_amount = amounts
+    # No payment for pending bills, the full amount stays as credit
+    paid_amount = _to_decimal(data.get('paid_amount')) if is_completed else Decimal('0')
     
-    # Create sale
     sale = Sale.objects.create(
         sale_number=sale_number,
         patient=patient,
@@ -535,97 +686,127 @@ def create_direct_sale(request):
         subtotal=subtotal,
         tax_amount=tax_amount,
         discount_amount=discount_amount,
-        total_amount=calculated_total,
+        total_amount=total_amount,
         amount_paid=paid_amount,
-        credit_amount=max(0, calculated_total - paid_amount),
-        change_amount=max(0, paid_amount - calculated_total),
+        credit_amount=max(0, total_amount - paid_amount),
+        change_amount=max(0, paid_amount - total_amount),
         payment_method=data.get('payment_method', 'cash'),
-        transaction_id=data.get('transaction_id', ''),
-        organization_id=request.user.organization_id,
+        transaction_id=data.get('transaction_id', '') if is_completed else '',
+        organization_id=org_id,
         branch_id=branch_id,
         created_by=request.user,
-        completed_by=request.user,
-        status='completed'
+        completed_by=request.user if is_completed else None,
+        status=status
     )
     
-    # Process sale items with stock reduction
-    items = data.get('items', [])
-    for item_data in items:
-        product = get_object_or_404(Product, id=item_data['medicine_id'])
-        batch_info = item_data.get('batch_info', [])
+    # Process sale items
+    sale_allocations = _create_sale_items(sale, data.get('items', []), products)
+    
+    if is_completed:
+        _reduce_stock(sale_allocations, branch_id, now)
         
-        # Create sale item
-        SaleItem.objects.create(
-            sale=sale,
-            product=product,
-            quantity=item_data['quantity'],
-            unit_price=item_data['price'],
-            batch_number=item_data.get('batch', ''),
-            allocated_batches=batch_info
-        )
+        # Handle split payments or single payment
+        Payment.objects.bulk_create(_build_payments(sale, data, paid_amount, request.user))
+    
+    return sale, [sale_item for sale_item, _ in sale_allocations]
+
+
+def _reduce_stock(sale_allocations, branch_id, now):
+    """Reduce stock for (sale_item, batch_info) pairs, falling back to FIFO."""
+    allocated_stock = Counter()
+    for sale_item, batch_info in sale_allocations:
+        product = sale_item.product
+        quantity = sale_item.quantity
+        total_allocated, batch_quantities = _group_batch_quantities(batch_info)
         
-        # Reduce stock - handle both allocated batches and FIFO fallback
-        if batch_info:
+        if batch_info and total_allocated == quantity:
             # Use allocated batches
-            for batch in batch_info:
-                inventory_item = get_object_or_404(InventoryItem, id=batch['inventory_item_id'])
-                allocated_qty = batch['allocated_quantity']
-                
-                if inventory_item.quantity >= allocated_qty:
-                    inventory_item.quantity -= allocated_qty
-                    inventory_item.save()
-                else:
-                    raise ValueError(f"Insufficient stock in batch {batch['batch_number']}")
-        else:
-            # FIFO fallback if no batch info
-            print(f"DEBUG: No batch info for {product.name}, using FIFO allocation")
-            inventory_items = InventoryItem.objects.filter(
-                product_id=product.id,
-                branch_id=branch_id,
-                quantity__gt=0,
-                is_active=True
-            ).order_by('expiry_date', 'created_at')
-            
-            remaining_quantity = item_data['quantity']
-            for item in inventory_items:
-                if remaining_quantity <= 0:
-                    break
-                
-                allocated_quantity = min(item.quantity, remaining_quantity)
-                print(f"DEBUG: FIFO - Reducing {allocated_quantity} from batch {item.batch_number}")
-                
-                if item.quantity >= allocated_quantity:
-                    item.quantity -= allocated_quantity
-                    item.save()
-                    remaining_quantity -= allocated_quantity
-                else:
-                    raise ValueError(f"Insufficient stock in batch {item.batch_number}")
-            
-            if remaining_quantity > 0:
-                raise ValueError(f"Insufficient total stock for {product.name}")
+            allocated_stock.update(batch_quantities)
+            continue
+        
+        if batch_info and settings.POS_STRICT_BATCHES:
+            logger.warning("Stock allocation mismatch for %s: allocated %s, required %s", product.name, total_allocated, quantity)
+            raise ValueError(f"Stock allocation mismatch for {product.name}: allocated {total_allocated}, required {quantity}")
+        
+        # FIFO fallback when there is no batch info or it does not match the quantity
+        logger.debug("No matching batch allocation for %s, using FIFO allocation", product.name)
+        _reduce_stock_fifo(product, branch_id, quantity, now)
     
-    # Handle split payments or single payment
-    split_payments = data.get('split_payments')
-    if split_payments and len(split_payments) > 0:
-        # Create multiple payment records for split payments
-        for split_payment in split_payments:
-            if split_payment.get('amount') and float(split_payment['amount']) > 0:
-                Payment.objects.create(
-                    sale=sale,
-                    amount=float(split_payment['amount']),
-                    payment_method=split_payment.get('method', 'cash'),
-                    reference_number=split_payment.get('transaction_id', ''),
-                    received_by=request.user
-                )
-    elif paid_amount > 0:
-        # Single payment record
-        Payment.objects.create(
-            sale=sale,
-            amount=paid_amount,
-            payment_method=data.get('payment_method', 'cash'),
-            reference_number=data.get('transaction_id', ''),
-            received_by=request.user
-        )
+    _reduce_allocated_stock(allocated_stock, now)
+
+
+def _reduce_stock_fifo(product, branch_id, quantity, now):
+    """Reduce a product's stock from its earliest expiring batches first."""
+    # Lock the candidate batches so concurrent sales queue on them
+    inventory_items = InventoryItem.objects.select_for_update().filter(
+        product_id=product.id,
+        branch_id=branch_id,
+        quantity__gt=0,
+        is_active=True
+    ).order_by('expiry_date', 'created_at').only('id', 'batch_number', 'quantity')
+    
+    remaining_quantity = quantity
+    for item in inventory_items:
+        if remaining_quantity <= 0:
+            break
+        
+        allocated_quantity = min(item.quantity, remaining_quantity)
+        logger.debug("FIFO - Reducing %s from batch %s (current: %s)", allocated_quantity, item.batch_number, item.quantity)
+        
+        # The quantity guard makes the decrement fail instead of
+        # overselling when another sale depleted the batch meanwhile
+        updated = InventoryItem.objects.filter(
+            id=item.id, quantity__gte=allocated_quantity
+        ).update(quantity=F('quantity') - allocated_quantity, updated_at=now)
+        if not updated:
+            raise ValueError(f"Insufficient stock in batch {item.batch_number}")
+        remaining_quantity -= allocated_quantity
+    
+    if remaining_quantity > 0:
+        logger.debug("FIFO - Could not allocate all stock. Remaining: %s", remaining_quantity)
+        raise ValueError(f"Insufficient total stock for {product.name}")
+
+
+def _group_batch_quantities(batch_info):
+    """Total a line's batch allocation and group it per inventory item in one pass."""
+    total_allocated = 0
+    quantities = Counter()
+    for batch in batch_info:
+        total_allocated += batch['allocated_quantity']
+        quantities[int(batch['inventory_item_id'])] += batch['allocated_quantity']
+    return total_allocated, quantities
+
+
+def _reduce_allocated_stock(quantities, now):
+    """Reduce stock by {inventory_item_id: quantity} with one locked read and one bulk update."""
+    if not quantities:
+        return
+    
+    # Lock the batches in id order so concurrent sales acquire the row locks
+    # in the same order and cannot deadlock
+    inventory_items = list(InventoryItem.objects.select_for_update().filter(id__in=quantities).order_by('id'))
+    if len(inventory_items) != len(quantities):
+        raise Http404('No InventoryItem matches the given query.')
+    
+    for inventory_item in inventory_items:
+        if inventory_item.quantity < quantities[inventory_item.id]:
+            raise ValueError(f"Insufficient stock in batch {inventory_item.batch_number}")
+        inventory_item.quantity -= quantities[inventory_item.id]
+        inventory_item.updated_at = now
+    InventoryItem.objects.bulk_update(inventory_items, ['quantity', 'updated_at'], batch_size=200)
+
+
+def create_direct_sale(request):
+    """Create a direct sale with immediate stock reduction."""
+    items = request.data.get('items', [])
+    branch_id = request.data.get('branch_id') or request.user.branch_id
+    # Unknown products are a 404, checked before the stock
+    products = _get_products(items)
+    shortages = _find_stock_shortages(items, branch_id)
+    if shortages:
+        return _stock_shortage_response(shortages)
+    
+    sale, _ = _persist_sale(request, 'completed', products=products)
     
     return Response({
         'success': True,
@@ -640,290 +821,49 @@ def create_direct_sale(request):
 def create_sale(request):
     """Create a new sale - wrapper for backward compatibility."""
     try:
+        data = request.data
+        logger.debug("create_sale called")
+        logger.debug("Items in request: %s", data.get('items', []))
+        
+        # This endpoint keeps the totals calculated by the client
+        amounts = (
+            _to_decimal(data.get('subtotal')),
+            _to_decimal(data.get('tax_amount')),
+            _to_decimal(data.get('discount_amount')),
+            _to_decimal(data.get('total')),
+        )
+        # Unknown products are a 404, checked before the stock
+        products = _get_products(data.get('items', []))
+        shortages = _find_stock_shortages(data.get('items', []), data.get('branch_id') or request.user.branch_id)
+        if shortages:
+            return _stock_shortage_response(shortages)
+        
         with transaction.atomic():
-            data = request.data
-            print(f"DEBUG: create_sale called")
-            print(f"DEBUG: Items in request: {data.get('items', [])}")
-            
-            # Get organization and branch IDs
-            org_id = getattr(request.user, 'organization_id', None)
-            branch_id = data.get('branch_id') or getattr(request.user, 'branch_id', None)
-            
-            # Create new direct sale
-            patient = None
-            patient_name = data.get('patient_name', '').strip()
-            patient_phone = data.get('patient_phone', '').strip()
-            patient_id = data.get('patient_id', '').strip()
-            
-            if patient_id:
-                try:
-                    patient = Patient.objects.get(patient_id=patient_id)
-                except Patient.DoesNotExist:
-                    pass
-            
-            if not patient and patient_name:
-                timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-                anonymous_patient_id = f"PT_{org_id}_{timestamp}"
-                
-                patient = Patient.objects.create(
-                    patient_id=anonymous_patient_id,
-                    first_name=patient_name.split()[0] if patient_name else 'Anonymous',
-                    last_name=' '.join(patient_name.split()[1:]) if len(patient_name.split()) > 1 else 'Patient',
-                    date_of_birth=date.today(),
-                    gender=data.get('patient_gender', 'other'),
-                    phone=patient_phone or '0000000000',
-                    address='Walk-in Customer',
-                    city='Unknown',
-                    organization_id=org_id,
-                    branch_id=branch_id,
-                    patient_type='outpatient',
-                    created_by=request.user
-                )
-            
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            sale_number = f"BILL_{branch_id}_{timestamp}"
-            
-            subtotal = float(data.get('subtotal', 0))
-            tax_amount = float(data.get('tax_amount', 0))
-            discount_amount = float(data.get('discount_amount', 0))
-            total_amount = float(data.get('total', 0))
-            paid_amount = float(data.get('paid_amount', 0))
-            
-            sale = Sale.objects.create(
-                sale_number=sale_number,
-                patient=patient,
-                patient_name=patient_name or (patient.get_full_name() if patient else 'Walk-in Customer'),
-                patient_age=data.get('patient_age', ''),
-                patient_phone=patient_phone,
-                patient_gender=data.get('patient_gender', ''),
-                sale_type=data.get('payment_method', 'cash'),
-                subtotal=subtotal,
-                tax_amount=tax_amount,
-                discount_amount=discount_amount,
-                total_amount=total_amount,
-                amount_paid=paid_amount,
-                credit_amount=max(0, total_amount - paid_amount),
-                change_amount=max(0, paid_amount - total_amount),
-                payment_method=data.get('payment_method', 'cash'),
-                transaction_id=data.get('transaction_id', ''),
-                organization_id=org_id,
-                branch_id=branch_id,
-                created_by=request.user,
-                completed_by=request.user,
-                status='completed'
-            )
-            
-            items = data.get('items', [])
-            print(f"DEBUG: create_sale - Processing {len(items)} items")
-            
-            for item_data in items:
-                product = get_object_or_404(Product, id=item_data['medicine_id'])
-                batch_info = item_data.get('batch_info', [])
-                quantity = item_data['quantity']
-                
-                print(f"DEBUG: create_sale - Processing {product.name}, quantity: {quantity}")
-                print(f"DEBUG: create_sale - Batch info: {batch_info}")
-                
-                SaleItem.objects.create(
-                    sale=sale,
-                    product=product,
-                    quantity=quantity,
-                    unit_price=item_data['price'],
-                    batch_number=item_data.get('batch', ''),
-                    allocated_batches=batch_info
-                )
-                
-                # Reduce stock - handle both allocated batches and FIFO fallback
-                if batch_info:
-                    # Check if allocated quantity matches sale quantity
-                    total_allocated = sum(batch['allocated_quantity'] for batch in batch_info)
-                    print(f"DEBUG: create_sale - Total allocated: {total_allocated}, Sale quantity: {quantity}")
-                    
-                    if total_allocated != quantity:
-                        print(f"DEBUG: create_sale - Allocation mismatch! Using FIFO for {product.name}")
-                        # Use FIFO fallback when allocation doesn't match
-                        inventory_items = InventoryItem.objects.filter(
-                            product_id=product.id,
-                            branch_id=branch_id,
-                            quantity__gt=0,
-                            is_active=True
-                        ).order_by('expiry_date', 'created_at')
-                        
-                        remaining_quantity = quantity
-                        for item in inventory_items:
-                            if remaining_quantity <= 0:
-                                break
-                            
-                            allocated_quantity = min(item.quantity, remaining_quantity)
-                            print(f"DEBUG: create_sale - FIFO reducing {allocated_quantity} from batch {item.batch_number}")
-                            
-                            if item.quantity >= allocated_quantity:
-                                item.quantity -= allocated_quantity
-                                item.save()
-                                remaining_quantity -= allocated_quantity
-                                print(f"DEBUG: create_sale - FIFO reduced. New qty: {item.quantity}, remaining: {remaining_quantity}")
-                            else:
-                                raise ValueError(f"Insufficient stock in batch {item.batch_number}")
-                        
-                        if remaining_quantity > 0:
-                            raise ValueError(f"Insufficient total stock for {product.name}")
-                    else:
-                        print(f"DEBUG: create_sale - Using allocated batches for {product.name}")
-                        # Use allocated batches
-                        for batch in batch_info:
-                            inventory_item = get_object_or_404(InventoryItem, id=batch['inventory_item_id'])
-                            allocated_qty = batch['allocated_quantity']
-                            print(f"DEBUG: create_sale - Reducing {allocated_qty} from batch {batch['batch_number']} (current: {inventory_item.quantity})")
-
-                            if inventory_item.quantity >= allocated_qty:
-                                inventory_item.quantity -= allocated_qty
-                                inventory_item.save()
-                                print(f"DEBUG: create_sale - Stock reduced. New quantity: {inventory_item.quantity}")
-                            else:
-                                print(f"DEBUG: create_sale - ERROR - Insufficient stock")
-                                raise ValueError(f"Insufficient stock in batch {batch['batch_number']}")
-                else:
-                    # FIFO fallback if no batch info
-                    print(f"DEBUG: create_sale - No batch info for {product.name}, using FIFO allocation")
-                    inventory_items = InventoryItem.objects.filter(
-                        product_id=product.id,
-                        branch_id=branch_id,
-                        quantity__gt=0,
-                        is_active=True
-                    ).order_by('expiry_date', 'created_at')
-                    
-                    print(f"DEBUG: create_sale - Found {inventory_items.count()} inventory items for FIFO")
-                    remaining_quantity = quantity
-                    
-                    for item in inventory_items:
-                        if remaining_quantity <= 0:
-                            break
-                        
-                        allocated_quantity = min(item.quantity, remaining_quantity)
-                        print(f"DEBUG: create_sale - FIFO reducing {allocated_quantity} from batch {item.batch_number} (current: {item.quantity})")
-                        
-                        if item.quantity >= allocated_quantity:
-                            item.quantity -= allocated_quantity
-                            item.save()
-                            remaining_quantity -= allocated_quantity
-                            print(f"DEBUG: create_sale - FIFO reduced. New qty: {item.quantity}, remaining: {remaining_quantity}")
-                        else:
-                            print(f"DEBUG: create_sale - FIFO ERROR - Insufficient stock")
-                            raise ValueError(f"Insufficient stock in batch {item.batch_number}")
-                    
-                    if remaining_quantity > 0:
-                        print(f"DEBUG: create_sale - FIFO ERROR - Could not allocate all stock. Remaining: {remaining_quantity}")
-                        raise ValueError(f"Insufficient total stock for {product.name}")
-                
-                print(f"DEBUG: create_sale - Completed stock reduction for {product.name}")
-            
-            # Handle split payments or single payment
-            split_payments = data.get('split_payments')
-            if split_payments and len(split_payments) > 0:
-                # Create multiple payment records for split payments
-                for split_payment in split_payments:
-                    if split_payment.get('amount') and float(split_payment['amount']) > 0:
-                        Payment.objects.create(
-                            sale=sale,
-                            amount=float(split_payment['amount']),
-                            payment_method=split_payment.get('method', 'cash'),
-                            reference_number=split_payment.get('transaction_id', ''),
-                            received_by=request.user
-                        )
-            elif paid_amount > 0:
-                # Single payment record
-                Payment.objects.create(
-                    sale=sale,
-                    amount=paid_amount,
-                    payment_method=data.get('payment_method', 'cash'),
-                    reference_number=data.get('transaction_id', ''),
-                    received_by=request.user
-                )
-            
-            # Generate receipt data with POS settings
-            organization = Organization.objects.get(id=org_id) if org_id else None
-            branch = sale.branch
-            
-            # Get POS settings for receipt
-            try:
-                pos_settings = POSSettings.objects.get(organization_id=org_id, branch_id=branch_id)
-                business_name = pos_settings.business_name or (organization.name if organization else '')
-                business_address = pos_settings.business_address or getattr(organization, 'address', '')
-                business_phone = pos_settings.business_phone or getattr(organization, 'phone', '')
-                business_email = pos_settings.business_email or getattr(organization, 'email', '')
-                receipt_footer = pos_settings.receipt_footer or 'Thank you for your business!'
-                receipt_logo = request.build_absolute_uri(pos_settings.receipt_logo.url) if pos_settings.receipt_logo else None
-                tax_rate = pos_settings.tax_rate
-            except POSSettings.DoesNotExist:
-                business_name = organization.name if organization else ''
-                business_address = getattr(organization, 'address', '')
-                business_phone = getattr(organization, 'phone', '')
-                business_email = getattr(organization, 'email', '')
-                receipt_footer = 'Thank you for your business!'
-                receipt_logo = None
-                tax_rate = 13
-            
-            receipt_data = {
-                'organization': {
-                    'name': business_name,
-                    'address': business_address,
-                    'phone': business_phone,
-                    'email': business_email
-                },
-                'branch': {
-                    'name': branch.name if branch else '',
-                    'address': getattr(branch, 'address', ''),
-                    'phone': getattr(branch, 'phone', '')
-                },
-                'settings': {
-                    'receipt_footer': receipt_footer,
-                    'receipt_logo': receipt_logo,
-                    'tax_rate': tax_rate
-                },
-                'sale': {
-                    'sale_number': sale.sale_number,
-                    'sale_date': sale.created_at.strftime('%Y-%m-%d %I:%M %p'),
-                    'cashier': request.user.get_full_name() or request.user.username
-                },
-                'patient': {
-                    'name': sale.patient_name,
-                    'patient_id': sale.patient.patient_id if sale.patient else '',
-                    'age': sale.patient_age,
-                    'phone': sale.patient_phone,
-                    'gender': sale.patient_gender
-                },
-                'items': [{
-                    'name': item.product.name,
-                    'quantity': item.quantity,
-                    'unit_price': float(item.unit_price),
-                    'total': float(item.quantity * item.unit_price),
-                    'batch': item.batch_number
-                } for item in sale.items.all()],
-                'totals': {
-                    'subtotal': float(sale.subtotal),
-                    'tax': float(sale.tax_amount),
-                    'discount': float(sale.discount_amount),
-                    'total': float(sale.total_amount),
-                    'paid': float(sale.amount_paid),
-                    'credit': float(sale.credit_amount),
-                    'change': float(sale.change_amount)
-                },
-                'payment_method': sale.payment_method
-            }
-            
-            print(f"DEBUG: create_sale - Sale completed successfully: {sale.sale_number}")
-            return Response({
-                'success': True,
-                'sale_id': sale.id,
-                'sale_number': sale.sale_number,
-                'message': 'Sale created successfully',
-                'receipt': receipt_data
-            })
-            
+            sale, sale_items = _persist_sale(request, 'completed', amounts, products)
+        
+        # Generate receipt data with POS settings once the sale is committed
+        sale = Sale.objects.select_related('organization', 'branch', 'patient').defer('notes', 'internal_notes').get(id=sale.id)
+        receipt_data = _build_completed_receipt(request, sale, sale_items)
+        
+        logger.debug("create_sale - Sale completed successfully: %s", sale.sale_number)
+        return Response({
+            'success': True,
+            'sale_id': sale.id,
+            'sale_number': sale.sale_number,
+            'message': 'Sale created successfully',
+            'receipt': receipt_data
+        })
+        
+    except Http404 as e:
+        return Response({'error': str(e)}, status=404)
+    except ValueError as e:
+        # Stock shortages, allocation mismatches and malformed quantities
+        return Response({'error': str(e)}, status=400)
+    except IntegrityError:
+        logger.exception("create_sale failed")
+        return Response({'error': 'The sale could not be saved because it conflicts with existing data'}, status=409)
     except Exception as e:
-        print(f"DEBUG: create_sale ERROR: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("create_sale failed")
         return Response({'error': str(e)}, status=500)
 
 
@@ -940,43 +880,212 @@ def get_pending_bills(request):
             branch_id=branch_id,
             organization_id=request.user.organization_id,
             status='pending'
-        ).order_by('-created_at')
+        ).values(
+            'id', 'sale_number', 'patient_name', 'patient__patient_id', 'patient_age',
+            'patient_phone', 'patient_gender', 'subtotal', 'total_amount', 'discount_amount',
+            'tax_amount', 'payment_method', 'created_at', 'created_by',
+            'created_by__first_name', 'created_by__last_name', 'created_by__email'
+        )
+        paginator = None
+        if _paginate_sales(request):
+            paginator = SaleCursorPagination()
+            pending_sales = paginator.paginate_queryset(pending_sales, request)
+        else:
+            pending_sales = list(pending_sales.order_by('-created_at'))
+        
+        # Batch allocations can be skipped and loaded per bill from the batches endpoint
+        include_batches = request.GET.get('include_batches', 'true').lower() != 'false'
+        item_fields = ['sale_id', 'product_id', 'product__name', 'quantity', 'unit_price', 'batch_number']
+        if include_batches:
+            item_fields.append('allocated_batches')
+        
+        # Load the items of every bill in one query
+        items_by_sale = defaultdict(list)
+        sale_items = SaleItem.objects.filter(sale_id__in=[sale['id'] for sale in pending_sales]).values(*item_fields)
+        for item in sale_items:
+            bill_item = {
+                'medicine_id': item['product_id'],
+                'name': item['product__name'],
+                'quantity': item['quantity'],
+                'price': float(item['unit_price']),
+                'batch': item['batch_number']
+            }
+            if include_batches:
+                bill_item['batch_info'] = SaleItem.expand_batches(item['allocated_batches'])
+            items_by_sale[item['sale_id']].append(bill_item)
         
         bills_data = []
         for sale in pending_sales:
             bills_data.append({
-                'id': sale.id,
-                'sale_number': sale.sale_number,
-                'patientName': sale.patient_name,
-                'patientId': sale.patient.patient_id if sale.patient else '',
-                'patientAge': sale.patient_age,
-                'patientPhone': sale.patient_phone,
-                'patientGender': sale.patient_gender,
-                'items': [
-                    {
-                        'medicine_id': item.product.id,
-                        'name': item.product.name,
-                        'quantity': item.quantity,
-                        'price': float(item.unit_price),
-                        'batch': item.batch_number,
-                        'batch_info': item.allocated_batches
-                    } for item in sale.items.all()
-                ],
-                'subtotal': float(sale.subtotal),
-                'total': float(sale.total_amount),
-                'discountAmount': float(sale.discount_amount),
-                'taxAmount': float(sale.tax_amount),
-                'paymentMethod': sale.payment_method,
-                'createdAt': sale.created_at.strftime('%Y-%m-%d %I:%M %p'),
-                'createdBy': sale.created_by.get_full_name() if sale.created_by else 'Unknown'
+                'id': sale['id'],
+                'sale_number': sale['sale_number'],
+                'patientName': sale['patient_name'],
+                'patientId': sale['patient__patient_id'] or '',
+                'patientAge': sale['patient_age'],
+                'patientPhone': sale['patient_phone'],
+                'patientGender': sale['patient_gender'],
+                'items': items_by_sale[sale['id']],
+                'subtotal': float(sale['subtotal']),
+                'total': float(sale['total_amount']),
+                'discountAmount': float(sale['discount_amount']),
+                'taxAmount': float(sale['tax_amount']),
+                'paymentMethod': sale['payment_method'],
+                'createdAt': sale['created_at'].isoformat(timespec='seconds'),
+                'createdBy': _user_full_name(sale, 'created_by')
             })
         
+        if paginator:
+            return paginator.get_paginated_response(bills_data)
         return Response(bills_data)
         
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
 
+class SaleCursorPagination(CursorPagination):
+    """Cursor pagination for the POS sale lists, newest first."""
+    ordering = '-created_at'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+# Most recent sales returned when a sale list is not paginated; clients
+# that need older sales page through them with ?cursor= or ?page_size=
+SALES_LIST_LIMIT = 500
+
+
+def _paginate_sales(request):
+    """Check whether the client asked for a paginated sale list."""
+    return 'cursor' in request.GET or 'page_size' in request.GET
+
+
+# Sale columns read for the sales list
+SALE_LIST_FIELDS = (
+    'id', 'sale_number', 'patient_name', 'patient__patient_id', 'patient_age',
+    'patient_phone', 'patient_gender', 'subtotal', 'total_amount', 'discount_amount',
+    'tax_amount', 'payment_method', 'amount_paid', 'credit_amount', 'change_amount',
+    'created_at', 'completed_by', 'completed_by__first_name', 'completed_by__last_name',
+    'completed_by__email', 'derived_status'
+)
+
+
+def _serialize_sales(sales):
+    """Serialize sales list values() rows, loading their items and payments."""
+    sale_ids = [sale['id'] for sale in sales]
+    
+    # Load items and payment records of every sale in one query each
+    items_by_sale = defaultdict(list)
+    sale_items = SaleItem.objects.filter(sale_id__in=sale_ids).values(
+        'sale_id', 'product__name', 'quantity', 'unit_price', 'discount_amount', 'batch_number'
+    )
+    for item in sale_items:
+        items_by_sale[item['sale_id']].append({
+            'name': item['product__name'],
+            'quantity': item['quantity'],
+            'price': float(item['unit_price']),
+            'batch': item['batch_number'],
+            'total': float(item['quantity'] * item['unit_price'] - item['discount_amount'])
+        })
+    
+    payments_by_sale = defaultdict(list)
+    payments = Payment.objects.filter(sale_id__in=sale_ids).values(
+        'sale_id', 'amount', 'payment_method', 'reference_number', 'payment_date',
+        'received_by', 'received_by__first_name', 'received_by__last_name', 'received_by__email'
+    )
+    for payment in payments:
+        payments_by_sale[payment['sale_id']].append({
+            'amount': float(payment['amount']),
+            'method': payment['payment_method'],
+            'reference': payment['reference_number'],
+            'date': payment['payment_date'].isoformat(timespec='seconds'),
+            'receivedBy': _user_full_name(payment, 'received_by')
+        })
+    
+    return [
+        _serialize_sale_row(sale, items_by_sale[sale['id']], payments_by_sale[sale['id']])
+        for sale in sales
+    ]
+
+
+def _summarize_payments(payments):
+    """Total serialized payments per method in a single pass."""
+    payment_summary = {'cash': 0, 'online': 0, 'card': 0}
+    for payment in payments:
+        if payment['method'] in payment_summary:
+            payment_summary[payment['method']] += payment['amount']
+    return payment_summary
+
+
+def _serialize_sale_row(sale, items, payments):
+    """Serialize a sales list values() row with its serialized items and payments."""
+    credit_amount = sale['credit_amount']
+    
+    # Calculate payment breakdown by method
+    payment_summary = _summarize_payments(payments)
+    
+    # Create payment breakdown for display
+    payment_breakdown = []
+    if payment_summary['cash'] > 0:
+        payment_breakdown.append(f"Cash: NPR {payment_summary['cash']:.2f}")
+    if payment_summary['online'] > 0:
+        payment_breakdown.append(f"Online: NPR {payment_summary['online']:.2f}")
+    if payment_summary['card'] > 0:
+        payment_breakdown.append(f"Card: NPR {payment_summary['card']:.2f}")
+    if credit_amount > 0:
+        payment_breakdown.append(f"Credit: NPR {credit_amount:.2f}")
+    
+    # Determine if it's a split payment
+    payment_methods_used = len([method for method, amount in payment_summary.items() if amount > 0])
+    is_split_payment = payment_methods_used > 1 or (payment_methods_used >= 1 and credit_amount > 0)
+    
+    return {
+        'id': sale['sale_number'],
+        'patientName': sale['patient_name'],
+        'patientId': sale['patient__patient_id'] or '',
+        'patientAge': sale['patient_age'],
+        'patientPhone': sale['patient_phone'],
+        'patientGender': sale['patient_gender'],
+        'items': items,
+        'subtotal': float(sale['subtotal']),
+        'total': float(sale['total_amount']),
+        'discountAmount': float(sale['discount_amount']),
+        'taxAmount': float(sale['tax_amount']),
+        'paymentMethod': 'Split Payment' if is_split_payment else sale['payment_method'],
+        'paidAmount': float(sale['amount_paid']),
+        'creditAmount': float(credit_amount),
+        'changeAmount': float(sale['change_amount']),
+        'completedAt': sale['created_at'].isoformat(timespec='seconds'),
+        'completedBy': _user_full_name(sale, 'completed_by'),
+        'payments': payments,
+        'paymentSummary': payment_summary,
+        'paymentBreakdown': payment_breakdown,
+        'isSplitPayment': is_split_payment,
+        'status': sale['derived_status']
+    }
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_pending_bill_batches(request, sale_id):
+    """Get the batch allocations of a pending bill's items."""
+    try:
+        get_object_or_404(Sale, id=sale_id, status='pending', organization_id=request.user.organization_id)
+        
+        sale_items = SaleItem.objects.filter(sale_id=sale_id).values('product_id', 'allocated_batches')
+        return Response([
+            {
+                'medicine_id': item['product_id'],
+                'batch_info': SaleItem.expand_batches(item['allocated_batches'])
+            } for item in sale_items
+        ])
+        
+    except Http404:
+        return Response({'error': 'Pending bill not found'}, status=404)
+    except Exception as e:
+        return Response({'error': str(e)}, status=500)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_sales(request):
@@ -997,77 +1106,21 @@ def get_sales(request):
         patient_id = request.GET.get('patient_id')
         if patient_id:
             sales_query = sales_query.filter(patient_id=patient_id)
-
-        sales = sales_query.order_by('-created_at')
         
-        sales_data = []
-        for sale in sales:
-            # Get payment records
-            payments = sale.payments.all()
-            payment_details = [{
-                'amount': float(payment.amount),
-                'method': payment.payment_method,
-                'reference': payment.reference_number,
-                'date': payment.payment_date.strftime('%Y-%m-%d %I:%M %p'),
-                'receivedBy': payment.received_by.get_full_name() if payment.received_by else 'Unknown'
-            } for payment in payments]
-            
-            # Calculate payment breakdown by method
-            payment_summary = {
-                'cash': sum(p['amount'] for p in payment_details if p['method'] == 'cash'),
-                'online': sum(p['amount'] for p in payment_details if p['method'] == 'online'),
-                'card': sum(p['amount'] for p in payment_details if p['method'] == 'card')
-            }
-            
-            # Create payment breakdown for display
-            payment_breakdown = []
-            if payment_summary['cash'] > 0:
-                payment_breakdown.append(f"Cash: NPR {payment_summary['cash']:.2f}")
-            if payment_summary['online'] > 0:
-                payment_breakdown.append(f"Online: NPR {payment_summary['online']:.2f}")
-            if payment_summary['card'] > 0:
-                payment_breakdown.append(f"Card: NPR {payment_summary['card']:.2f}")
-            if sale.credit_amount > 0:
-                payment_breakdown.append(f"Credit: NPR {sale.credit_amount:.2f}")
-            
-            # Determine if it's a split payment
-            payment_methods_used = len([method for method, amount in payment_summary.items() if amount > 0])
-            is_split_payment = payment_methods_used > 1 or (payment_methods_used >= 1 and sale.credit_amount > 0)
-            
-            sales_data.append({
-                'id': sale.sale_number,
-                'patientName': sale.patient_name,
-                'patientId': sale.patient.patient_id if sale.patient else '',
-                'patientAge': sale.patient_age,
-                'patientPhone': sale.patient_phone,
-                'patientGender': sale.patient_gender,
-                'items': [
-                    {
-                        'name': item.product.name,
-                        'quantity': item.quantity,
-                        'price': float(item.unit_price),
-                        'batch': item.batch_number,
-                        'total': float(item.line_total)
-                    } for item in sale.items.all()
-                ],
-                'subtotal': float(sale.subtotal),
-                'total': float(sale.total_amount),
-                'discountAmount': float(sale.discount_amount),
-                'taxAmount': float(sale.tax_amount),
-                'paymentMethod': 'Split Payment' if is_split_payment else sale.payment_method,
-                'paidAmount': float(sale.amount_paid),
-                'creditAmount': float(sale.credit_amount),
-                'changeAmount': float(sale.change_amount),
-                'completedAt': sale.created_at.strftime('%Y-%m-%d %I:%M %p'),
-                'completedBy': sale.completed_by.get_full_name() if sale.completed_by else 'Unknown',
-                'payments': payment_details,
-                'paymentSummary': payment_summary,
-                'paymentBreakdown': payment_breakdown,
-                'isSplitPayment': is_split_payment,
-                'status': 'credit' if sale.credit_amount > 0 else 'completed'
-            })
+        # Sales with outstanding credit are listed as 'credit'
+        sales_query = sales_query.annotate(derived_status=Case(
+            When(credit_amount__gt=0, then=Value('credit')),
+            default=Value('completed'),
+            output_field=CharField()
+        ))
+
+        if _paginate_sales(request):
+            paginator = SaleCursorPagination()
+            page = paginator.paginate_queryset(sales_query.values(*SALE_LIST_FIELDS), request)
+            return paginator.get_paginated_response(_serialize_sales(page))
         
-        return Response(sales_data)
+        sales = list(sales_query.order_by('-created_at').values(*SALE_LIST_FIELDS)[:SALES_LIST_LIMIT])
+        return Response(_serialize_sales(sales))
         
     except Exception as e:
         return Response({'error': str(e)}, status=500)
@@ -1083,30 +1136,41 @@ def patient_credit_history(request):
             return Response({'error': 'patient_id parameter is required'}, status=400)
 
         # Get sales with outstanding credit for this patient
-        credit_sales = Sale.objects.filter(
+        credit_sales = list(Sale.objects.filter(
             patient_id=patient_id,
             organization_id=request.user.organization_id,
             credit_amount__gt=0,
             status='completed'
-        ).select_related('patient').order_by('-created_at')
+        ).order_by('-created_at').values(
+            'id', 'sale_number', 'total_amount', 'amount_paid', 'credit_amount',
+            'created_at', 'payment_method', 'transaction_id'
+        ))
+
+        # Load the items of every credit sale in one query
+        items_by_sale = defaultdict(list)
+        sale_items = SaleItem.objects.filter(sale_id__in=[sale['id'] for sale in credit_sales]).values_list(
+            'sale_id', 'product__name', 'quantity', 'unit_price'
+        )
+        for sale_id, product_name, quantity, unit_price in sale_items:
+            items_by_sale[sale_id].append({
+                'product_name': product_name,
+                'quantity': quantity,
+                'unit_price': float(unit_price),
+                'total': float(quantity * unit_price)
+            })
 
         credit_data = []
         for sale in credit_sales:
             credit_data.append({
-                'id': sale.id,
-                'sale_number': sale.sale_number,
-                'total_amount': float(sale.total_amount),
-                'amount_paid': float(sale.amount_paid),
-                'credit_amount': float(sale.credit_amount),
-                'created_at': sale.created_at.isoformat(),
-                'payment_method': sale.payment_method,
-                'transaction_id': sale.transaction_id,
-                'items': [{
-                    'product_name': item.product.name,
-                    'quantity': item.quantity,
-                    'unit_price': float(item.unit_price),
-                    'total': float(item.quantity * item.unit_price)
-                } for item in sale.items.all()]
+                'id': sale['id'],
+                'sale_number': sale['sale_number'],
+                'total_amount': float(sale['total_amount']),
+                'amount_paid': float(sale['amount_paid']),
+                'credit_amount': float(sale['credit_amount']),
+                'created_at': sale['created_at'].isoformat(timespec='seconds'),
+                'payment_method': sale['payment_method'],
+                'transaction_id': sale['transaction_id'],
+                'items': items_by_sale[sale['id']]
             })
 
         return Response(credit_data)
@@ -1120,10 +1184,16 @@ def patient_credit_history(request):
 def get_sale_detail(request, sale_id):
     """Get detailed sale information."""
     try:
-        sale = get_object_or_404(Sale, sale_number=sale_id, organization_id=request.user.organization_id)
+        sale_query = Sale.objects.select_related('patient', 'completed_by').defer(
+            'notes', 'internal_notes'
+        ).prefetch_related(
+            Prefetch('items', queryset=SaleItem.objects.select_related('product')),
+            Prefetch('payments', queryset=Payment.objects.select_related('received_by').order_by('payment_date'))
+        )
+        sale = get_object_or_404(sale_query, sale_number=sale_id, organization_id=request.user.organization_id)
         
         # Get all payment records for this sale
-        payments = sale.payments.all().order_by('payment_date')
+        payments = sale.payments.all()
         payment_details = []
         
         for payment in payments:
@@ -1132,7 +1202,7 @@ def get_sale_detail(request, sale_id):
                 'amount': float(payment.amount),
                 'method': payment.payment_method,
                 'reference': payment.reference_number or '',
-                'date': payment.payment_date.strftime('%Y-%m-%d %I:%M %p'),
+                'date': payment.payment_date.isoformat(timespec='seconds'),
                 'receivedBy': payment.received_by.get_full_name() if payment.received_by else 'Unknown'
             })
         
@@ -1143,10 +1213,12 @@ def get_sale_detail(request, sale_id):
                 'amount': float(sale.amount_paid),
                 'method': sale.payment_method,
                 'reference': sale.transaction_id or '',
-                'date': sale.created_at.strftime('%Y-%m-%d %I:%M %p'),
+                'date': sale.created_at.isoformat(timespec='seconds'),
                 'receivedBy': sale.completed_by.get_full_name() if sale.completed_by else 'Unknown'
             })
         
+        payment_summary = _summarize_payments(payment_details)
+        
         sale_data = {
             'id': sale.sale_number,
             'patientName': sale.patient_name,
@@ -1170,21 +1242,16 @@ def get_sale_detail(request, sale_id):
             'paymentMethod': sale.payment_method,
             'paidAmount': float(sale.amount_paid),
             'creditAmount': float(sale.credit_amount),
-            'completedAt': sale.created_at.strftime('%Y-%m-%d %I:%M %p'),
+            'completedAt': sale.created_at.isoformat(timespec='seconds'),
             'completedBy': sale.completed_by.get_full_name() if sale.completed_by else 'Unknown',
             'status': 'credit' if sale.credit_amount > 0 else 'completed',
             'payments': payment_details,
             'totalPayments': len(payment_details),
-            'paymentSummary': {
-                'cash': sum(p['amount'] for p in payment_details if p['method'] == 'cash'),
-                'online': sum(p['amount'] for p in payment_details if p['method'] == 'online'),
-                'card': sum(p['amount'] for p in payment_details if p['method'] == 'card')
-            },
-            'paymentBreakdown': [p for p in [
-                {'method': 'Cash', 'amount': sum(p['amount'] for p in payment_details if p['method'] == 'cash')},
-                {'method': 'Online', 'amount': sum(p['amount'] for p in payment_details if p['method'] == 'online')},
-                {'method': 'Card', 'amount': sum(p['amount'] for p in payment_details if p['method'] == 'card')}
-            ] if p['amount'] > 0]
+            'paymentSummary': payment_summary,
+            'paymentBreakdown': [
+                {'method': method.capitalize(), 'amount': amount}
+                for method, amount in payment_summary.items() if amount > 0
+            ]
         }
         
         return Response(sale_data)
@@ -1198,7 +1265,11 @@ def get_sale_detail(request, sale_id):
 def delete_sale(request, sale_id):
     """Delete a sale (admin only)."""
     try:
-        sale = get_object_or_404(Sale, sale_number=sale_id, organization_id=request.user.organization_id)
+        sale = get_object_or_404(
+            Sale.objects.only('id', 'sale_number', 'organization_id'),
+            sale_number=sale_id,
+            organization_id=request.user.organization_id
+        )
         
         # Only allow deletion if user has admin permissions
         if not request.user.is_staff:
@@ -1206,16 +1277,21 @@ def delete_sale(request, sale_id):
         
         # Restore inventory quantities
         with transaction.atomic():
-            for item in sale.items.all():
-                if item.allocated_batches:
-                    for batch in item.allocated_batches:
-                        try:
-                            inventory_item = InventoryItem.objects.get(id=batch['inventory_item_id'])
-                            inventory_item.quantity += batch['allocated_quantity']
-                            inventory_item.save()
-                        except InventoryItem.DoesNotExist:
-                            pass
+            restore_quantities = Counter()
+            for item in sale.items.only('id', 'allocated_batches'):
+                restore_quantities.update(_group_batch_quantities(item.batches)[1])
+            
+            # Batches that no longer exist are skipped
+            inventory_items = InventoryItem.objects.select_for_update().filter(
+                id__in=restore_quantities
+            ).order_by('id').in_bulk()
+            now = timezone.now()
+            for inventory_item in inventory_items.values():
+                inventory_item.quantity += restore_quantities[inventory_item.id]
+                inventory_item.updated_at = now
+            InventoryItem.objects.bulk_update(inventory_items.values(), ['quantity', 'updated_at'], batch_size=200)
             
+            _clear_receipt_cache(sale)
             sale.delete()
         
         return Response({'success': True, 'message': 'Sale deleted successfully'})
@@ -1234,36 +1310,29 @@ def pos_stats(request):
         
         today = timezone.now().date()
         
-        # Today's sales
-        today_sales = Sale.objects.filter(
+        # Today's, total and credit sales in a single aggregate query
+        today_filter = Q(created_at__date=today)
+        credit_filter = Q(credit_amount__gt=0)
+        stats = Sale.objects.filter(
             branch_id=branch_id,
             organization_id=org_id,
-            created_at__date=today,
-            status='completed'
-        )
-        
-        # Total sales
-        total_sales = Sale.objects.filter(
-            branch_id=branch_id,
-            organization_id=org_id,
-            status='completed'
-        )
-        
-        # Credit sales
-        credit_sales = Sale.objects.filter(
-            branch_id=branch_id,
-            organization_id=org_id,
-            credit_amount__gt=0,
             status='completed'
+        ).aggregate(
+            today_sales_count=Count('id', filter=today_filter),
+            today_sales_amount=Sum('total_amount', filter=today_filter),
+            total_sales_count=Count('id'),
+            total_sales_amount=Sum('total_amount'),
+            credit_sales_count=Count('id', filter=credit_filter),
+            credit_amount=Sum('credit_amount', filter=credit_filter),
         )
         
         return Response({
-            'today_sales_count': today_sales.count(),
-            'today_sales_amount': sum(sale.total_amount for sale in today_sales),
-            'total_sales_count': total_sales.count(),
-            'total_sales_amount': sum(sale.total_amount for sale in total_sales),
-            'credit_sales_count': credit_sales.count(),
-            'credit_amount': sum(sale.credit_amount for sale in credit_sales),
+            'today_sales_count': stats['today_sales_count'],
+            'today_sales_amount': stats['today_sales_amount'] or 0,
+            'total_sales_count': stats['total_sales_count'],
+            'total_sales_amount': stats['total_sales_amount'] or 0,
+            'credit_sales_count': stats['credit_sales_count'],
+            'credit_amount': stats['credit_amount'] or 0,
         })
         
     except Exception as e:
@@ -1275,12 +1344,26 @@ def pos_stats(request):
 def generate_receipt(request, sale_id):
     """Generate receipt data for a completed sale."""
     try:
+        org_id = request.user.organization_id
+        cache_key = _receipt_cache_key(org_id, sale_id)
+        receipt_data = cache.get(cache_key)
+        if receipt_data is not None:
+            return Response(_with_absolute_logo(request, receipt_data))
+        
         # Try to get by ID first, then by sale_number
+        sale_query = Sale.objects.select_related('organization', 'branch', 'patient', 'created_by').only(
+            'id', 'sale_number', 'created_at', 'status', 'organization_id', 'branch_id',
+            'subtotal', 'tax_amount', 'discount_amount', 'total_amount', 'amount_paid',
+            'credit_amount', 'change_amount', 'patient_name', 'patient_age', 'patient_phone',
+            'patient_gender', 'patient__patient_id', 'organization__name', 'organization__address',
+            'organization__phone', 'organization__email', 'branch__name', 'created_by__first_name',
+            'created_by__last_name', 'created_by__email'
+        )
         try:
             if sale_id.isdigit():
-                sale = Sale.objects.get(id=sale_id, organization_id=request.user.organization_id)
+                sale = sale_query.get(id=sale_id, organization_id=org_id)
             else:
-                sale = Sale.objects.get(sale_number=sale_id, organization_id=request.user.organization_id)
+                sale = sale_query.get(sale_number=sale_id, organization_id=org_id)
         except Sale.DoesNotExist:
             return Response({'error': 'Sale not found'}, status=404)
         
@@ -1293,43 +1376,35 @@ def generate_receipt(request, sale_id):
         branch = sale.branch
         
         # Get POS settings for receipt
-        try:
-            pos_settings = POSSettings.objects.get(organization_id=sale.organization_id, branch_id=sale.branch_id)
-            business_name = pos_settings.business_name or organization.name
-            business_address = pos_settings.business_address or getattr(organization, 'address', '')
-            business_phone = pos_settings.business_phone or getattr(organization, 'phone', '')
-            business_email = pos_settings.business_email or getattr(organization, 'email', '')
-            receipt_footer = pos_settings.receipt_footer or 'Thank you for your business!'
-            receipt_logo = request.build_absolute_uri(pos_settings.receipt_logo.url) if pos_settings.receipt_logo else None
-            tax_rate = pos_settings.tax_rate
-        except POSSettings.DoesNotExist:
-            business_name = organization.name
-            business_address = getattr(organization, 'address', '')
-            business_phone = getattr(organization, 'phone', '')
-            business_email = getattr(organization, 'email', '')
-            receipt_footer = 'Thank you for your business!'
-            receipt_logo = None
-            tax_rate = 13
+        pos_context = _load_pos_context(organization, sale.branch_id)
+        
+        # Stream the lines; bulk orders can carry hundreds of items
+        receipt_items = sale.items.values_list(
+            'product__name', 'quantity', 'unit_price', 'discount_amount', 'batch_number'
+        ).iterator(chunk_size=200)
+        payments = sale.payments.values_list(
+            'payment_method', 'amount', 'reference_number', 'payment_date'
+        )
         
         # Prepare receipt data
         receipt_data = {
             'organization': {
-                'name': business_name,
-                'address': business_address,
-                'phone': business_phone,
-                'email': business_email
+                'name': pos_context['business_name'],
+                'address': pos_context['business_address'],
+                'phone': pos_context['business_phone'],
+                'email': pos_context['business_email']
             },
             'branch': {
                 'name': branch.name if branch else ''
             },
             'settings': {
-                'receipt_footer': receipt_footer,
-                'receipt_logo': receipt_logo,
-                'tax_rate': tax_rate
+                'receipt_footer': pos_context['receipt_footer'],
+                'receipt_logo': pos_context['receipt_logo'],
+                'tax_rate': pos_context['tax_rate']
             },
             'sale': {
                 'sale_number': sale.sale_number,
-                'sale_date': sale.created_at.strftime('%Y-%m-%d %I:%M %p'),
+                'sale_date': sale.created_at.isoformat(timespec='seconds'),
                 'cashier': sale.created_by.get_full_name() if sale.created_by else 'Unknown'
             },
             'patient': {
@@ -1339,7 +1414,14 @@ def generate_receipt(request, sale_id):
                 'phone': sale.patient_phone,
                 'gender': sale.patient_gender
             },
-            'items': [],
+            'items': [{
+                'name': name,
+                'quantity': quantity,
+                'unit_price': float(unit_price),
+                'discount': float(discount_amount),
+                'total': float(quantity * unit_price - discount_amount),
+                'batch': batch_number
+            } for name, quantity, unit_price, discount_amount, batch_number in receipt_items],
             'totals': {
                 'subtotal': float(sale.subtotal),
                 'discount': float(sale.discount_amount),
@@ -1349,31 +1431,20 @@ def generate_receipt(request, sale_id):
                 'credit': float(sale.credit_amount),
                 'change': float(sale.change_amount)
             },
-            'receipt_footer': receipt_footer,
-            'payments': []
+            'receipt_footer': pos_context['receipt_footer'],
+            'payments': [{
+                'method': method,
+                'amount': float(amount),
+                'reference': reference_number,
+                'date': payment_date.isoformat(timespec='seconds')
+            } for method, amount, reference_number, payment_date in payments]
         }
         
-        # Add items
-        for item in sale.items.all():
-            receipt_data['items'].append({
-                'name': item.product.name,
-                'quantity': item.quantity,
-                'unit_price': float(item.unit_price),
-                'discount': float(item.discount_amount),
-                'total': float(item.line_total),
-                'batch': item.batch_number
-            })
-        
-        # Add payment details
-        for payment in sale.payments.all():
-            receipt_data['payments'].append({
-                'method': payment.payment_method,
-                'amount': float(payment.amount),
-                'reference': payment.reference_number,
-                'date': payment.payment_date.strftime('%Y-%m-%d %I:%M %p')
-            })
+        # Completed sales only change through credit payments, which clear this entry
+        if sale.status == 'completed':
+            cache.set(cache_key, receipt_data, RECEIPT_CACHE_TIMEOUT)
         
-        return Response(receipt_data)
+        return Response(_with_absolute_logo(request, receipt_data))
         
     except Exception as e:
         return Response({'error': str(e)}, status=500)
@@ -1385,15 +1456,28 @@ def process_credit_payment(request, sale_id):
     """Process payment for a credit sale."""
     try:
         with transaction.atomic():
-            sale = get_object_or_404(Sale, sale_number=sale_id, organization_id=request.user.organization_id)
-            
-            if sale.credit_amount <= 0:
-                return Response({'error': 'No outstanding credit for this sale'}, status=400)
+            sale = get_object_or_404(
+                Sale.objects.select_for_update(),
+                sale_number=sale_id,
+                organization_id=request.user.organization_id
+            )
             
-            payment_amount = float(request.data.get('amount', 0))
+            payment_amount = _to_decimal(request.data.get('amount'))
             payment_method = request.data.get('payment_method', 'cash')
             reference_number = request.data.get('reference_number', '')
             
+            # A retried request with the same reference must not pay twice. The
+            # sale row lock serializes concurrent attempts for this check.
+            if reference_number and sale.payments.filter(reference_number=reference_number).exists():
+                return Response({
+                    'error': 'A payment with this reference number was already recorded',
+                    'remaining_credit': float(sale.credit_amount),
+                    'total_paid': float(sale.amount_paid)
+                }, status=409)
+            
+            if sale.credit_amount <= 0:
+                return Response({'error': 'No outstanding credit for this sale'}, status=400)
+            
             if payment_amount <= 0:
                 return Response({'error': 'Payment amount must be greater than 0'}, status=400)
             
@@ -1409,18 +1493,25 @@ def process_credit_payment(request, sale_id):
                 received_by=request.user
             )
             
-            # Update sale amounts
-            sale.amount_paid += payment_amount
-            sale.credit_amount -= payment_amount
-            sale.save()
+            # Update sale amounts in the database
+            Sale.objects.filter(pk=sale.pk).update(
+                amount_paid=F('amount_paid') + payment_amount,
+                credit_amount=F('credit_amount') - payment_amount,
+                updated_at=timezone.now()
+            )
+            transaction.on_commit(lambda: _clear_receipt_cache(sale))
             
+            # The row is locked, so the new totals follow from the values read above
             return Response({
                 'success': True,
                 'message': 'Payment processed successfully',
-                'remaining_credit': float(sale.credit_amount),
-                'total_paid': float(sale.amount_paid)
+                'remaining_credit': float(sale.credit_amount - payment_amount),
+                'total_paid': float(sale.amount_paid + payment_amount)
             })
             
+    except ValueError as e:
+        # Malformed payment amount
+        return Response({'error': str(e)}, status=400)
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
@@ -1433,20 +1524,17 @@ def validate_stock_before_sale(request):
         items = request.data.get('items', [])
         branch_id = request.data.get('branch_id') or request.user.branch_id
         
+        # Get available stock for every requested product in one grouped query
+        product_ids = {int(item['medicine_id']) for item in items if item.get('medicine_id')}
+        stocks = _get_available_stock(product_ids, branch_id)
+        
         validation_results = []
         all_valid = True
         
         for item in items:
             medicine_id = item.get('medicine_id')
             required_quantity = int(item.get('quantity', 0))
-            
-            # Get available stock
-            available_stock = InventoryItem.objects.filter(
-                product_id=medicine_id,
-                branch_id=branch_id,
-                quantity__gt=0,
-                is_active=True
-            ).aggregate(total=models.Sum('quantity'))['total'] or 0
+            available_stock = stocks.get(int(medicine_id), 0) if medicine_id else 0
             
             is_valid = available_stock >= required_quantity
             if not is_valid:
@@ -1469,25 +1557,53 @@ def validate_stock_before_sale(request):
         return Response({'error': str(e)}, status=500)
 
 
+def _branch_q(branch_id, prefix=''):
+    """Get the filter for a selected dashboard branch, or an empty one for 'all'."""
+    if branch_id and branch_id != 'all':
+        return Q(**{f'{prefix}branch_id': branch_id})
+    return Q()
+
+
+def _get_stock_counts(org_id, branch_id, today):
+    """Get the critical and expiring stock counts of a dashboard, cached for a few minutes."""
+    cache_key = f"pos:stock-counts:{org_id}:{branch_id if branch_id and branch_id != 'all' else 'all'}:{today}"
+    stock_counts = cache.get(cache_key)
+    if stock_counts is None:
+        # Critical Stock (items below minimum stock level) and Expiring Soon
+        # (items expiring within 30 days) counted in one aggregate
+        stock_counts = InventoryItem.objects.filter(
+            _branch_q(branch_id),
+            branch__organization_id=org_id,
+            is_active=True
+        ).aggregate(
+            critical_stock=Count('id', filter=(
+                Q(quantity__lte=F('min_stock_level')) | Q(min_stock_level__isnull=True, quantity__lte=10)
+            )),
+            expiring_soon=Count('id', filter=Q(
+                expiry_date__isnull=False,
+                expiry_date__lte=today + timedelta(days=30),
+                expiry_date__gte=today,
+                quantity__gt=0
+            ))
+        )
+        cache.set(cache_key, stock_counts, STOCK_COUNTS_CACHE_TIMEOUT)
+    return stock_counts
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def pharmacy_dashboard_stats(request):
     """Get pharmacy dashboard statistics for pharmacy owner."""
     try:
-        print("DEBUG: Starting pharmacy_dashboard_stats")
         org_id = getattr(request.user, 'organization_id', None)
-        print(f"DEBUG: org_id = {org_id}")
         if not org_id:
-            print("DEBUG: No organization_id found")
             return Response({'error': 'User not associated with an organization'}, status=400)
 
         # Get date filter from request
         date_filter = request.GET.get('date_filter', 'today')
-        print(f"DEBUG: date_filter = {date_filter}")
 
         # Calculate date range based on filter
         today = timezone.now().date()
-        print(f"DEBUG: today = {today}")
         if date_filter == 'today':
             start_date = today
             end_date = today
@@ -1503,81 +1619,42 @@ def pharmacy_dashboard_stats(request):
         else:
             start_date = today
             end_date = today
-        print(f"DEBUG: date range = {start_date} to {end_date}")
 
-        # Get branch filter
+        # Get selected branch
         branch_id = request.GET.get('branch_id')
-        print(f"DEBUG: branch_id = {branch_id}")
-        branch_filter = Q()
-        if branch_id and branch_id != 'all':
-            branch_filter = Q(branch_id=branch_id)
-        print(f"DEBUG: branch_filter = {branch_filter}")
-
-        # Total Sales
-        print("DEBUG: Calculating total sales")
-        total_sales_query = Sale.objects.filter(
-            organization_id=org_id,
-            created_at__date__gte=start_date,
-            created_at__date__lte=end_date,
-            status='completed'
-        ).filter(branch_filter)
-        print(f"DEBUG: total_sales_query count = {total_sales_query.count()}")
-        total_sales = total_sales_query.aggregate(
-            total=Sum('total_amount')
-        )['total'] or 0
-        print(f"DEBUG: total_sales = {total_sales}")
+        logger.debug("pharmacy_dashboard_stats - org %s, branch %s, %s to %s", org_id, branch_id, start_date, end_date)
 
-        # Patient Credit (outstanding credit from sales)
-        print("DEBUG: Calculating patient credit")
-        patient_credit_query = Sale.objects.filter(
+        # Total Sales and Patient Credit (outstanding credit from sales) in one aggregate
+        sale_totals = Sale.objects.filter(
+            _branch_q(branch_id),
             organization_id=org_id,
-            credit_amount__gt=0,
             status='completed'
-        ).filter(branch_filter)
-        print(f"DEBUG: patient_credit_query count = {patient_credit_query.count()}")
-        patient_credit = patient_credit_query.aggregate(
-            total=Sum('credit_amount')
-        )['total'] or 0
-        print(f"DEBUG: patient_credit = {patient_credit}")
+        ).aggregate(
+            total_sales=Sum('total_amount', filter=Q(
+                created_at__date__gte=start_date,
+                created_at__date__lte=end_date
+            )),
+            patient_credit=Sum('credit_amount', filter=Q(credit_amount__gt=0))
+        )
+        total_sales = sale_totals['total_sales'] or 0
+        patient_credit = sale_totals['patient_credit'] or 0
 
         # Supplier Credit (from bulk orders - calculate outstanding payments)
-        print("DEBUG: Calculating supplier credit")
         from inventory.models import BulkOrder
         supplier_credit_query = BulkOrder.objects.filter(
+            _branch_q(branch_id, 'buyer_'),
             buyer_organization_id=org_id,
             status__in=['confirmed', 'shipped', 'delivered'],
             remaining_amount__gt=0
-        ).filter(branch_filter)
-        print(f"DEBUG: supplier_credit_query count = {supplier_credit_query.count()}")
+        )
         supplier_credit = supplier_credit_query.aggregate(
             total=Sum('remaining_amount')
         )['total'] or 0
-        print(f"DEBUG: supplier_credit = {supplier_credit}")
-
-        # Critical Stock (items below minimum stock level)
-        print("DEBUG: Calculating critical stock")
-        from inventory.models import InventoryItem
-        critical_stock_query = InventoryItem.objects.filter(
-            branch__organization_id=org_id,
-            is_active=True
-        ).filter(branch_filter).filter(
-            Q(quantity__lte=F('min_stock_level')) | Q(min_stock_level__isnull=True, quantity__lte=10)
-        )
-        critical_stock_items = critical_stock_query.count()
-        print(f"DEBUG: critical_stock_items = {critical_stock_items}")
 
-        # Expiring Soon (items expiring within 30 days)
-        print("DEBUG: Calculating expiring items")
-        expiring_soon_query = InventoryItem.objects.filter(
-            branch__organization_id=org_id,
-            expiry_date__isnull=False,
-            expiry_date__lte=today + timedelta(days=30),
-            expiry_date__gte=today,
-            is_active=True,
-            quantity__gt=0
-        ).filter(branch_filter)
-        expiring_soon = expiring_soon_query.count()
-        print(f"DEBUG: expiring_soon = {expiring_soon}")
+        # Critical Stock and Expiring Soon
+        stock_counts = _get_stock_counts(org_id, branch_id, today)
+        critical_stock_items = stock_counts['critical_stock']
+        expiring_soon = stock_counts['expiring_soon']
 
         result = {
             'totalSales': float(total_sales),
@@ -1586,13 +1663,11 @@ def pharmacy_dashboard_stats(request):
             'criticalStock': critical_stock_items,
             'expiringItems': expiring_soon
         }
-        print(f"DEBUG: Final result = {result}")
+        logger.debug("pharmacy_dashboard_stats - result %s", result)
         return Response(result)
 
     except Exception as e:
-        print(f"DEBUG: Exception occurred: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("pharmacy_dashboard_stats failed")
         return Response({'error': str(e)}, status=500)
 
 
@@ -1608,58 +1683,60 @@ def pharmacy_sales_chart(request):
         date_filter = request.GET.get('date_filter', 'today')
         branch_id = request.GET.get('branch_id')
 
-        branch_filter = Q()
-        if branch_id and branch_id != 'all':
-            branch_filter = Q(branch_id=branch_id)
-
         today = timezone.now().date()
 
+        cache_key = f"pos:sales-chart:{org_id}:{branch_id or 'all'}:{date_filter}:{today}"
+        sales_data = cache.get(cache_key)
+        if sales_data is not None:
+            return Response(sales_data)
+
+        completed_sales = Sale.objects.filter(
+            _branch_q(branch_id),
+            organization_id=org_id,
+            status='completed'
+        ).order_by()
+
         if date_filter == 'today':
-            # Hourly data for today
+            # Hourly data for today, grouped by hour in one query
+            hourly_sales = {
+                row['bucket']: row for row in completed_sales.filter(created_at__date=today).annotate(
+                    bucket=ExtractHour('created_at')
+                ).values('bucket').annotate(sales=Sum('total_amount'), leads=Count('id'))
+            }
+
             sales_data = []
             for hour in range(9, 20):  # 9 AM to 7 PM
-                hour_start = timezone.make_aware(datetime.combine(today, datetime.min.time().replace(hour=hour)))
-                hour_end = timezone.make_aware(datetime.combine(today, datetime.min.time().replace(hour=hour+1)))
-
-                hour_sales = Sale.objects.filter(
-                    organization_id=org_id,
-                    created_at__gte=hour_start,
-                    created_at__lt=hour_end,
-                    status='completed'
-                ).filter(branch_filter).aggregate(
-                    sales=Sum('total_amount'),
-                    leads=Count('id')
-                )
-
+                hour_sales = hourly_sales.get(hour, {})
                 sales_data.append({
                     'name': f'{hour}:00',
-                    'sales': float(hour_sales['sales'] or 0),
-                    'leads': hour_sales['leads'] or 0
+                    'sales': float(hour_sales.get('sales') or 0),
+                    'leads': hour_sales.get('leads', 0)
                 })
         else:
-            # Daily data for the period
+            # Daily data for the period, grouped by day in one query
             days_count = 7 if date_filter == 'week' else 30 if date_filter == 'month' else 365
             start_date = today - timedelta(days=days_count)
+            end_date = start_date + timedelta(days=days_count - 1)
+
+            daily_sales = {
+                row['bucket']: row for row in completed_sales.filter(
+                    created_at__date__range=(start_date, end_date)
+                ).annotate(
+                    bucket=TruncDate('created_at')
+                ).values('bucket').annotate(sales=Sum('total_amount'), leads=Count('id'))
+            }
 
             sales_data = []
             for i in range(days_count):
                 current_date = start_date + timedelta(days=i)
-
-                day_sales = Sale.objects.filter(
-                    organization_id=org_id,
-                    created_at__date=current_date,
-                    status='completed'
-                ).filter(branch_filter).aggregate(
-                    sales=Sum('total_amount'),
-                    leads=Count('id')
-                )
-
+                day_sales = daily_sales.get(current_date, {})
                 sales_data.append({
                     'name': current_date.strftime('%a'),  # Mon, Tue, etc.
-                    'sales': float(day_sales['sales'] or 0),
-                    'leads': day_sales['leads'] or 0
+                    'sales': float(day_sales.get('sales') or 0),
+                    'leads': day_sales.get('leads', 0)
                 })
 
+        cache.set(cache_key, sales_data, SALES_CHART_CACHE_TIMEOUT)
         return Response(sales_data)
 
     except Exception as e:
@@ -1671,73 +1748,63 @@ def pharmacy_sales_chart(request):
 def pharmacy_stock_categories(request):
     """Get stock categories pie chart data."""
     try:
-        print("DEBUG: Starting pharmacy_stock_categories")
         org_id = getattr(request.user, 'organization_id', None)
-        print(f"DEBUG: org_id = {org_id}")
         if not org_id:
-            print("DEBUG: No organization_id found")
             return Response({'error': 'User not associated with an organization'}, status=400)
 
         branch_id = request.GET.get('branch_id')
-        print(f"DEBUG: branch_id = {branch_id}")
-        branch_filter = Q()
-        if branch_id and branch_id != 'all':
-            branch_filter = Q(branch__organization_id=org_id, branch_id=branch_id)
-        else:
-            branch_filter = Q(branch__organization_id=org_id)
-        print(f"DEBUG: branch_filter = {branch_filter}")
 
-        from inventory.models import InventoryItem
-        print("DEBUG: Importing InventoryItem model")
-
-        # Group by product category and sum quantities
-        print("DEBUG: Building category_data query")
-        category_data_query = InventoryItem.objects.filter(
-            branch_filter,
+        # Group by product category and sum quantities (top 5 categories)
+        category_data = InventoryItem.objects.filter(
+            _branch_q(branch_id),
+            branch__organization_id=org_id,
             is_active=True,
             quantity__gt=0
         ).values(
             'product__category__name'
         ).annotate(
             total_stock=Sum('quantity')
-        ).order_by('-total_stock')
-        print(f"DEBUG: category_data_query SQL = {category_data_query.query}")
-        category_data = list(category_data_query)
-        print(f"DEBUG: category_data = {category_data}")
+        ).order_by('-total_stock')[:5]
 
-        # Format for pie chart (limit to top categories)
-        medicine_data = []
+        # Format for pie chart, one color per category
         colors = ['#8884d8', '#82ca9d', '#ffc658', '#ff7c7c', '#8dd1e1']
-
-        for i, category in enumerate(category_data[:5]):  # Top 5 categories
-            category_name = category['product__category__name'] or 'Uncategorized'
-            medicine_data.append({
-                'name': category_name,
+        medicine_data = [
+            {
+                'name': category['product__category__name'] or 'Uncategorized',
                 'value': category['total_stock'],
-                'color': colors[i % len(colors)]
-            })
-
-        print(f"DEBUG: medicine_data after processing = {medicine_data}")
+                'color': color
+            }
+            for category, color in zip(category_data, colors)
+        ]
 
         # If no categories, provide default data
         if not medicine_data:
-            print("DEBUG: No category data found, using defaults")
             medicine_data = [
                 {'name': 'Prescription', 'value': 2847, 'color': '#8884d8'},
                 {'name': 'OTC', 'value': 1234, 'color': '#82ca9d'},
                 {'name': 'Supplies', 'value': 567, 'color': '#ffc658'}
             ]
 
-        print(f"DEBUG: Final medicine_data = {medicine_data}")
+        logger.debug("pharmacy_stock_categories - org %s, branch %s: %s", org_id, branch_id, medicine_data)
         return Response(medicine_data)
 
     except Exception as e:
-        print(f"DEBUG: Exception in pharmacy_stock_categories: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("pharmacy_stock_categories failed")
         return Response({'error': str(e)}, status=500)
 
 
+def _time_ago(time_diff):
+    """Describe a timedelta like "3 hours ago" for the activity feed."""
+    hours, seconds = divmod(time_diff.seconds, 3600)
+    if time_diff.days > 0:
+        return f"{time_diff.days} days ago"
+    if hours > 0:
+        return f"{hours} hours ago"
+    if seconds // 60 > 0:
+        return f"{seconds // 60} mins ago"
+    return "Just now"
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def pharmacy_recent_activities(request):
@@ -1747,91 +1814,80 @@ def pharmacy_recent_activities(request):
         if not org_id:
             return Response({'error': 'User not associated with an organization'}, status=400)
 
-        branch_id = request.GET.get('branch_id')
-        branch_filter = Q()
-        if branch_id and branch_id != 'all':
-            branch_filter = Q(branch_id=branch_id)
+        branch_filter = _branch_q(request.GET.get('branch_id'))
+
+        now = timezone.now()
 
-        activities = []
+        # Low stock alerts (2 lowest) are stamped with the current time, so
+        # they always lead the feed
+        low_stock_items = list(InventoryItem.objects.filter(
+            branch_filter,
+            Q(quantity__lte=F('min_stock_level')) | Q(min_stock_level__isnull=True, quantity__lte=10),
+            branch__organization_id=org_id,
+            is_active=True
+        ).order_by('quantity').values('id', 'product__name', 'quantity')[:2])
 
-        # Get recent sales (last 5)
+        # Recent sales (last 5) and recent stock updates (last 3) share one
+        # column layout so a single UNION ALL query returns them already
+        # sorted, most recent first
         recent_sales = Sale.objects.filter(
+            branch_filter,
             organization_id=org_id,
             status='completed'
-        ).filter(branch_filter).select_related('created_by').order_by('-created_at')[:5]
-
-        for sale in recent_sales:
-            # Calculate time ago
-            time_diff = timezone.now() - sale.created_at
-            if time_diff.days > 0:
-                time_ago = f"{time_diff.days} days ago"
-            elif time_diff.seconds // 3600 > 0:
-                time_ago = f"{time_diff.seconds // 3600} hours ago"
-            elif time_diff.seconds // 60 > 0:
-                time_ago = f"{time_diff.seconds // 60} mins ago"
-            else:
-                time_ago = "Just now"
-
-            activities.append({
-                'id': f'sale_{sale.id}',
-                'type': 'sale',
-                'title': 'Sale completed',
-                'description': f'₹{float(sale.total_amount):.0f} • {time_ago}',
-                'amount': float(sale.total_amount),
-                'timestamp': sale.created_at.isoformat(),
-                'status': 'success'
-            })
+        ).order_by('-created_at').annotate(
+            activity_id=F('id'),
+            kind=Value('sale', output_field=CharField()),
+            label=Value('', output_field=CharField()),
+            amount=F('total_amount'),
+            units=Value(None, output_field=models.IntegerField()),
+            timestamp=F('created_at')
+        ).values('activity_id', 'kind', 'label', 'amount', 'units', 'timestamp')[:5]
 
-        # Get recent stock updates (from inventory items created/modified recently)
-        from inventory.models import InventoryItem
         recent_stock_updates = InventoryItem.objects.filter(
+            branch_filter,
             branch__organization_id=org_id
-        ).filter(branch_filter).select_related('product').order_by('-updated_at')[:3]
-
-        for item in recent_stock_updates:
-            # Calculate time ago
-            time_diff = timezone.now() - item.updated_at
-            if time_diff.days > 0:
-                time_ago = f"{time_diff.days} days ago"
-            elif time_diff.seconds // 3600 > 0:
-                time_ago = f"{time_diff.seconds // 3600} hours ago"
-            elif time_diff.seconds // 60 > 0:
-                time_ago = f"{time_diff.seconds // 60} mins ago"
-            else:
-                time_ago = "Just now"
-
-            activities.append({
-                'id': f'stock_{item.id}',
-                'type': 'stock',
-                'title': 'Stock updated',
-                'description': f'{item.product.name} • {time_ago}',
-                'timestamp': item.updated_at.isoformat(),
-                'status': 'info'
-            })
-
-        # Get low stock alerts
-        low_stock_items = InventoryItem.objects.filter(
-            branch__organization_id=org_id,
-            is_active=True
-        ).filter(branch_filter).filter(
-            Q(quantity__lte=F('min_stock_level')) | Q(min_stock_level__isnull=True, quantity__lte=10)
-        ).select_related('product').order_by('quantity')[:2]
-
-        for item in low_stock_items:
-            activities.append({
-                'id': f'alert_{item.id}',
-                'type': 'alert',
-                'title': 'Low stock alert',
-                'description': f'{item.product.name} • {item.quantity} units remaining',
-                'timestamp': timezone.now().isoformat(),
-                'status': 'warning'
-            })
-
-        # Sort activities by timestamp (most recent first)
-        activities.sort(key=lambda x: x['timestamp'], reverse=True)
+        ).order_by('-updated_at').annotate(
+            activity_id=F('id'),
+            kind=Value('stock', output_field=CharField()),
+            label=F('product__name'),
+            amount=Value(None, output_field=models.DecimalField()),
+            units=F('quantity'),
+            timestamp=F('updated_at')
+        ).values('activity_id', 'kind', 'label', 'amount', 'units', 'timestamp')[:3]
 
         # Return only the 8 most recent activities
-        return Response(activities[:8])
+        feed = recent_sales.union(recent_stock_updates, all=True).order_by('-timestamp')[:8 - len(low_stock_items)]
+
+        activities = [{
+            'id': f"alert_{item['id']}",
+            'type': 'alert',
+            'title': 'Low stock alert',
+            'description': f"{item['product__name']} • {item['quantity']} units remaining",
+            'timestamp': now.isoformat(),
+            'status': 'warning'
+        } for item in low_stock_items]
+        for row in feed:
+            if row['kind'] == 'sale':
+                activities.append({
+                    'id': f"sale_{row['activity_id']}",
+                    'type': 'sale',
+                    'title': 'Sale completed',
+                    'description': f"₹{float(row['amount']):.0f} • {_time_ago(now - row['timestamp'])}",
+                    'amount': float(row['amount']),
+                    'timestamp': row['timestamp'].isoformat(),
+                    'status': 'success'
+                })
+            else:
+                activities.append({
+                    'id': f"stock_{row['activity_id']}",
+                    'type': 'stock',
+                    'title': 'Stock updated',
+                    'description': f"{row['label']} • {_time_ago(now - row['timestamp'])}",
+                    'timestamp': row['timestamp'].isoformat(),
+                    'status': 'info'
+                })
+
+        return Response(activities)
 
     except Exception as e:
         return Response({'error': str(e)}, status=500)
@@ -1850,40 +1906,37 @@ def pos_settings(request):
         
         # For pharmacy owners without branch assignment, use the first branch or create default
         if not branch_id and request.user.role == 'pharmacy_owner':
-            from organizations.models import Branch
             try:
                 # Get the first branch of the organization
-                branch = Branch.objects.filter(organization_id=org_id).first()
-                if branch:
-                    branch_id = branch.id
-                else:
-                    return Response({'error': 'No branches found for organization'}, status=400)
+                branch_id = POSSettings.get_default_branch_id(org_id)
             except Exception:
                 return Response({'error': 'Unable to determine branch'}, status=400)
+            if not branch_id:
+                return Response({'error': 'No branches found for organization'}, status=400)
         elif not branch_id:
             return Response({'error': 'User not assigned to branch'}, status=400)
         
         if request.method == 'GET':
             # Get existing settings or return defaults
-            try:
-                settings = POSSettings.objects.get(organization_id=org_id, branch_id=branch_id)
+            settings = POSSettings.get_cached(org_id, branch_id)
+            if settings:
                 # Get full URL for logo
                 logo_url = None
-                if settings.receipt_logo:
-                    logo_url = request.build_absolute_uri(settings.receipt_logo.url)
+                if settings['receipt_logo']:
+                    logo_url = request.build_absolute_uri(settings['receipt_logo'])
                 
                 return Response({
-                    'business_name': settings.business_name,
-                    'business_address': settings.business_address,
-                    'business_phone': settings.business_phone,
-                    'business_email': settings.business_email,
-                    'receipt_footer': settings.receipt_footer,
+                    'business_name': settings['business_name'],
+                    'business_address': settings['business_address'],
+                    'business_phone': settings['business_phone'],
+                    'business_email': settings['business_email'],
+                    'receipt_footer': settings['receipt_footer'],
                     'receipt_logo': logo_url,
-                    'tax_rate': float(settings.tax_rate),
-                    'tax_inclusive': settings.tax_inclusive,
-                    'payment_methods': settings.payment_methods
+                    'tax_rate': float(settings['tax_rate']),
+                    'tax_inclusive': settings['tax_inclusive'],
+                    'payment_methods': settings['payment_methods']
                 })
-            except POSSettings.DoesNotExist:
+            else:
                 return Response({
                     'business_name': '',
                     'business_address': '',
@@ -1891,49 +1944,28 @@ def pos_settings(request):
                     'business_email': '',
                     'receipt_footer': '',
                     'receipt_logo': None,
-                    'tax_rate': 13.0,
+                    'tax_rate': float(DEFAULT_TAX_RATE),
                     'tax_inclusive': False,
                     'payment_methods': ['cash', 'online']
                 })
         
         elif request.method == 'POST':
-            # Save or update settings
-            data = request.data
-            
-            settings, created = POSSettings.objects.get_or_create(
+            # Save or update settings; only the fields sent by the client are updated
+            instance = POSSettings.objects.filter(
                 organization_id=org_id,
-                branch_id=branch_id,
-                defaults={'created_by': request.user}
-            )
-            
-            # Update fields
-            settings.business_name = data.get('business_name', settings.business_name)
-            settings.business_address = data.get('business_address', settings.business_address)
-            settings.business_phone = data.get('business_phone', settings.business_phone)
-            settings.business_email = data.get('business_email', settings.business_email)
-            settings.receipt_footer = data.get('receipt_footer', settings.receipt_footer)
-            settings.tax_rate = float(data.get('tax_rate', settings.tax_rate))
+                branch_id=branch_id
+            ).first()
+            serializer = POSSettingsSerializer(instance, data=request.data, partial=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=400)
             
-            # Handle boolean conversion for tax_inclusive
-            tax_inclusive_value = data.get('tax_inclusive', settings.tax_inclusive)
-            if isinstance(tax_inclusive_value, str):
-                settings.tax_inclusive = tax_inclusive_value.lower() == 'true'
-            else:
-                settings.tax_inclusive = bool(tax_inclusive_value)
-            
-            # Handle payment methods JSON
-            payment_methods_value = data.get('payment_methods', settings.payment_methods)
-            if isinstance(payment_methods_value, str):
-                import json
-                settings.payment_methods = json.loads(payment_methods_value)
-            else:
-                settings.payment_methods = payment_methods_value
-            
-            # Handle logo upload
+            extra_fields = {}
+            # Handle logo upload; a non-file receipt_logo (the URL sent back) is ignored
             if 'receipt_logo' in request.FILES:
-                settings.receipt_logo = request.FILES['receipt_logo']
-            
-            settings.save()
+                extra_fields['receipt_logo'] = request.FILES['receipt_logo']
+            if instance is None:
+                extra_fields.update(organization_id=org_id, branch_id=branch_id, created_by=request.user)
+            serializer.save(**extra_fields)
             
             return Response({
                 'success': True,